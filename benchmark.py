@@ -0,0 +1,136 @@
+#!/usr/bin/python3
+import argparse
+import os
+import re
+import struct
+import subprocess
+import sys
+import array
+import tempfile
+import timeit
+from datetime import datetime
+
+import ies2
+
+re_class_id = re.compile(r'ClassID="([0-9]+)"')
+
+
+def make_custom_shop(output, copies):
+    # Grow datatable_custom_shop.xml to a big table by repeating its rows with fresh ClassIDs
+    source = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'datatable_custom_shop.xml')
+    with open(source, encoding='euc-kr') as fp:
+        lines = [line for line in fp if '<Class ' in line]
+    rows = 0
+    with open(output, 'w', encoding='utf-8') as fp:
+        fp.write('<?xml version="1.0" encoding="UTF-8"?>\n<idspace id="custom_shop">\n')
+        for copy in range(copies):
+            for line in lines:
+                rows += 1
+                fp.write(re_class_id.sub('ClassID="{}"'.format(rows), line, count=1))
+        fp.write('</idspace>\n')
+    return rows
+
+
+def bench_numbers(values, repeat):
+    row_struct = struct.Struct('<{}d'.format(len(values)))
+
+    def per_value():
+        return b''.join(struct.pack('d', float(v)) for v in values)
+
+    def per_row_struct():
+        return row_struct.pack(*[float(v) for v in values])
+
+    def per_row_array():
+        return array.array('d', [float(v) for v in values]).tobytes()
+
+    assert per_value() == per_row_struct() == per_row_array()
+    for name, func in (('struct.pack per value', per_value),
+                       ('struct.Struct per row', per_row_struct),
+                       ('array.tobytes per row', per_row_array)):
+        print('  {:<24}{:.3f}s'.format(name, min(timeit.repeat(func, number=repeat, repeat=3))))
+
+
+def bench_xml_to_ies(xml_file, repeat):
+    output = xml_file[:-3] + 'ies'
+    best = None
+    for _ in range(repeat):
+        start_time = datetime.now()
+        ies2.xml_to_ies(xml_file, output, None, None, 'UTF-8', False)
+        elapsed = datetime.now() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+    print('  xml_to_ies              {}  ({} bytes)'.format(best, os.path.getsize(output)))
+
+
+def bench_parsers(xml_file, repeat):
+    output = xml_file[:-3] + 'ies'
+    installed = ies2.lxml_available()
+    backends = ['expat'] + (['lxml'] if installed else [])
+    for backend in backends:
+        ies2.xml_parser = backend
+        best = min(timeit.repeat(lambda: ies2.xml_to_ies(xml_file, output, None, None, 'UTF-8', False),
+                                 number=1, repeat=repeat))
+        print('  {:<24}{:.3f}s'.format(backend, best))
+    if not installed:
+        print('  lxml                    not installed')
+
+
+def bench_startup(temp_dir, repeat):
+    # Whole CLI run on a one-row table, so the time is dominated by interpreter start and imports
+    input_dir = os.path.join(temp_dir, 'startup')
+    os.mkdir(input_dir)
+    with open(os.path.join(input_dir, 'datatable_tiny.xml'), 'w', encoding='utf-8') as fp:
+        fp.write('<?xml version="1.0" encoding="UTF-8"?>\n<idspace id="tiny">\n'
+                 '\t<Class ClassID="1" ClassName="Tiny" Count="25" />\n</idspace>\n')
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ies2.py')
+    command = [sys.executable, script, '-e', 'UTF-8', input_dir]
+    best_run = best_imports = None
+    for _ in range(repeat):
+        start_time = datetime.now()
+        subprocess.run(command, cwd=temp_dir, stdout=subprocess.DEVNULL, check=True)
+        elapsed = datetime.now() - start_time
+        best_run = elapsed if best_run is None else min(best_run, elapsed)
+        result = subprocess.run(command[:1] + ['-X', 'importtime'] + command[1:], cwd=temp_dir,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True,
+                                check=True)
+        # Top level imports only, nested ones are included in their parent's cumulative time
+        imports = sum(int(line.split('|')[1]) for line in result.stderr.splitlines()
+                      if line.startswith('import time:') and line.split('|')[1].strip().isdigit()
+                      and not line.split('|')[2].startswith('  '))
+        best_imports = imports if best_imports is None else min(best_imports, imports)
+    print('  imports                 {:.1f}ms'.format(best_imports / 1000))
+    print('  first file processed    {}'.format(best_run))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ies2 converter benchmarks')
+    parser.add_argument('-n',
+                        '--repeat',
+                        type=int,
+                        default=3,
+                        help='Number of runs, best time is reported.')
+    parser.add_argument('-c',
+                        '--copies',
+                        type=int,
+                        default=16,
+                        help='How many times custom_shop rows are repeated (16 gives ~60k rows).')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        xml_file = os.path.join(temp_dir, 'datatable_custom_shop.xml')
+        rows = make_custom_shop(xml_file, args.copies)
+
+        print('Numeric column packing, {} rows of 8 numbers'.format(rows))
+        bench_numbers(['20000', '15282', '21544', '25', '0', '0', '0', '0'], rows)
+
+        print('Encoding custom_shop, {} rows'.format(rows))
+        bench_xml_to_ies(xml_file, args.repeat)
+
+        print('CLI startup, one-row table')
+        bench_startup(temp_dir, args.repeat)
+
+        print('XML parser backends, {} rows'.format(rows))
+        bench_parsers(xml_file, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,36 +1,97 @@
-
 #!/usr/bin/python3
 import argparse
+import codecs
+import io
 import os
 import re
 import struct
 import sys
-import glob
 import ctypes
 import array
-import logging
 from datetime import datetime
 from collections import OrderedDict
-from contextlib import suppress
-from xml.etree import ElementTree
-from xml.etree.ElementTree import ParseError
-from xml.sax.saxutils import escape, unescape
-
-import xml.etree.ElementTree as ET
+from contextlib import suppress, nullcontext
 
-import _thread
 import threading
 import time
 
+
+class LazyModule:
+    # Stand-in for a module that is only imported on first attribute access, keeps startup down to what the
+    # code path actually needs. The import lock makes the first access safe from worker threads.
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+
+    def __getattr__(self, attr):
+        module = self.__dict__.get('_module')
+        if module is None:
+            __import__(self._name)
+            module = self.__dict__['_module'] = sys.modules[self._name]
+        return getattr(module, attr)
+
+
+logging = LazyModule('logging')
+hashlib = LazyModule('hashlib')
+tempfile = LazyModule('tempfile')
+filecmp = LazyModule('filecmp')
+json = LazyModule('json')
+futures = LazyModule('concurrent.futures')
+expat = LazyModule('xml.parsers.expat')
+ET = LazyModule('xml.etree.ElementTree')
+lxml_etree = LazyModule('lxml.etree')
+
 re_localization = re.compile(r'<\$>([0-9]+)</>')
 re_number = re.compile(r'^-?[0-9]+(\.([0-9]+)?)?$')
+re_xml_declaration = re.compile(br'<\?xml[^>]*?encoding=["\']([A-Za-z0-9._-]+)["\']')
+# Self-closing tags as they appear in raw xml bytes, attribute values may hold '>'
+re_class_tag = re.compile(br'<Class(?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|\'[^\']*\'))*\s*/>')
+re_class_schema_tag = re.compile(br'<ClassSchema(?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|\'[^\']*\'))*\s*/>')
+re_class_open = re.compile(br'<Class[\s/>]')
+re_class_other = re.compile(br'<Class[^\s/]')
+
+# XML parser backend, expat (xml.etree) unless lxml is picked with --parser. lxml is not faster on the streaming
+# passes (see benchmark.py), so it is not the default even when installed.
+xml_parser = 'expat'
+
+
+def xml_backend():
+    return xml_parser
+
+
+def lxml_available():
+    try:
+        __import__('lxml.etree')
+    except ImportError:
+        return False
+    return True
+
+
+def escape(data, entities={}):
+    # Same as xml.sax.saxutils.escape, which would pull in urllib and http.client at import
+    data = data.replace('&', '&amp;').replace('>', '&gt;').replace('<', '&lt;')
+    for key, value in entities.items():
+        data = data.replace(key, value)
+    return data
+
+
+def unescape(data, entities={}):
+    # Same as xml.sax.saxutils.unescape
+    data = data.replace('&lt;', '<').replace('&gt;', '>')
+    for key, value in entities.items():
+        data = data.replace(key, value)
+    return data.replace('&amp;', '&')
+
+
 COL_TYPE_NUMBER = 0
 COL_TYPE_STRING = 1
 COL_TYPE_CALCULATED = 2
 
 
+__xor_table = bytes(c ^ 1 for c in range(256))
+
+
 def xor_str(string):
-    return array.array('B', [c ^ 1 for c in string]).tobytes()
+    return bytes(string).translate(__xor_table)
 
 
 class Struct(ctypes.Structure):
@@ -114,28 +175,92 @@ def indent(elem, level=0, more_sibs=False, order=None):
 
 
 def parse_order(xml_file):
+    # Rank attribute names by their summed positions over the childless <Class> elements whose attributes are all
+    # set. Streams the file through expat so memory stays flat whatever its size. Only attribute names matter
+    # and they are ASCII, so any 8-bit document is read as latin-1 regardless of its declared encoding.
     score = {}
-    r1 = re.compile(r'<Class(\s+([a-zA-Z0-9_]+)\s*=\s*"[^"]+")+\s*/>', re.IGNORECASE)
-    r2 = re.compile('="[^"]+"\s*')
-    with open(xml_file) as fp:
-        data = fp.read().replace('\r', '')
-        for m in r1.finditer(data):
-            cls = m.group()[6:-2].strip()
-            attrs = r2.split(cls)
-            for i, a in enumerate(attrs):
-                a = a.strip()
-                try:
-                    score[a] += i
-                except KeyError:
-                    score[a] = i
-    return list(k[0] for k in sorted(score.items(), key=lambda x: x[1]))
+    pending = []
+
+    def start(tag, attrs):
+        pending.clear()
+        if tag.lower() == 'class' and all(attrs[1::2]):
+            pending.extend(attrs[0::2])
+
+    def end(tag):
+        for i, name in enumerate(pending):
+            score[name] = score.get(name, 0) + i
+        pending.clear()
+
+    with open(xml_file, 'rb') as fp:
+        parser = expat.ParserCreate(None if sniff_xml_encoding(fp.read(4)) == 'UTF-16' else 'iso-8859-1')
+        fp.seek(0)
+        parser.ordered_attributes = True
+        parser.StartElementHandler = start
+        parser.EndElementHandler = end
+        try:
+            parser.ParseFile(fp)
+        except expat.ExpatError as e:
+            logging.warning('Order file {} only partially read: {}'.format(xml_file, e))
+    return sorted(score, key=score.get)
+
+
+class OrderCache:
+    # parse_order results for one order directory, memoized on disk next to the order files and
+    # revalidated per file by mtime and size
+    file_name = '.ies2_order.json'
+
+    def __init__(self, order_dir):
+        self.order_dir = order_dir
+        self.lock = threading.Lock()
+        self.dirty = False
+        try:
+            with open(os.path.join(order_dir, self.file_name), encoding='utf-8') as fp:
+                self.entries = json.load(fp)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def get(self, name):
+        xml_file = os.path.join(self.order_dir, name)
+        st = os.stat(xml_file)
+        stamp = [st.st_mtime_ns, st.st_size]
+        with self.lock:
+            entry = self.entries.get(name)
+        if entry is not None and entry['stamp'] == stamp:
+            return entry['order']
+        order = parse_order(xml_file)
+        with self.lock:
+            self.entries[name] = {'stamp': stamp, 'order': order}
+            self.dirty = True
+        return order
+
+    def save(self):
+        if not self.dirty:
+            return
+        data = json.dumps(self.entries, sort_keys=True).encode('utf-8')
+        try:
+            write_file_atomic(os.path.join(self.order_dir, self.file_name), data)
+        except OSError as e:
+            logging.warning('Order cache not saved: {}'.format(e))
+        self.dirty = False
+
+
+__order_caches = {}
+__order_lock = threading.Lock()
+
+
+def __order_cache(order_dir):
+    path = os.path.abspath(order_dir)
+    with __order_lock:
+        cache = __order_caches.get(path)
+        if cache is None:
+            cache = __order_caches[path] = OrderCache(path)
+    return cache
 
 
 def parse_dict(xml_file):
     result = {}
-    dom = ElementTree.parse(xml_file)
-    root = dom.getroot()
-    """:type : ElementTree.Element"""
+    root = parse_xml(xml_file)
+    """:type : ET.Element"""
     for txt in root.iterfind('./Text'):
         result[txt.attrib['ClassID']] = txt.attrib['Text']
     return result
@@ -150,213 +275,918 @@ def autodetect_output_file(input_file):
         return input_file + '.xml'
 
 
-def ies_to_xml(input, output, order, dictionary, encoding, use_float):
-    with open(input, 'rb') as fp:
-        fp.seek(0, os.SEEK_END)
-        total_size = fp.tell()
+def __scan_rows(data, hdr, number_width, offsets=None):
+    # Walk row boundaries using only the length fields; the layout is valid only if it ends exactly on data_size
+    pos = 0
+    end = len(data)
+    numbers_size = number_width * hdr.col_count_number
+    unpack_len = __string_len.unpack_from
+    strings = range(hdr.col_count_strings)
+    for row in range(hdr.row_count):
+        if offsets is not None:
+            offsets.append(pos)
+        if pos + 6 > end:
+            return 'Row {} header overruns data section'.format(row)
+        pos += 6 + unpack_len(data, pos + 4)[0] + numbers_size
+        for col in strings:
+            if pos + 2 > end:
+                return 'Row {} string {} length overruns data section'.format(row, col)
+            pos += 2 + unpack_len(data, pos)[0]
+        pos += hdr.col_count_strings
+        if pos > end:
+            return 'Row {} overruns data section by {} bytes'.format(row, pos - end)
+    if pos != end:
+        return 'Data section has {} trailing bytes after last row'.format(end - pos)
+    if offsets is not None:
+        offsets.append(pos)
+    return None
+
+
+def detect_number_width(data, hdr, offsets=None):
+    # offsets is filled with the row offsets of the detected layout, as __scan_rows does
+    if hdr.col_count_number == 0:
+        if offsets is not None and __scan_rows(data, hdr, 8, offsets) is not None:
+            del offsets[:]
+        return 8
+
+    # Every row has at least class id, class name length, string lengths and is_scr flags
+    fixed_size = hdr.row_count * (6 + 3 * hdr.col_count_strings)
+    candidates = [width for width in (8, 4)
+                  if fixed_size + hdr.row_count * hdr.col_count_number * width <= hdr.data_size]
+    for width in candidates:
+        if offsets is not None:
+            del offsets[:]
+        if __scan_rows(data, hdr, width, offsets) is None:
+            return width
+    raise Exception('Could not detect number width, data_size {} does not fit float or double layout'.format(
+        hdr.data_size))
+
+
+def read_ies_header(fp):
+    fp.seek(0, os.SEEK_END)
+    total_size = fp.tell()
+    fp.seek(0, os.SEEK_SET)
+    hdr = IESHeader()
+    hdr.read_from(fp)
+
+    if hdr.version == 1:
+        pass
+    elif hdr.version == 2:
         fp.seek(0, os.SEEK_SET)
-        hdr = IESHeader()
+        hdr = IESHeader2()
+        hdr.read_from(fp)
+    elif hdr.version == 3:
+        fp.seek(0, os.SEEK_SET)
+        hdr = IESHeader3()
         hdr.read_from(fp)
+    else:
+        raise Exception('Unknown ies version {}'.format(int(hdr.version)))
 
-        if hdr.version == 1:
-            pass
-        elif hdr.version == 2:
-            fp.seek(0, os.SEEK_SET)
-            hdr = IESHeader2()
-            hdr.read_from(fp)
-        elif hdr.version == 3:
-            fp.seek(0, os.SEEK_SET)
-            hdr = IESHeader3()
-            hdr.read_from(fp)
-        else:
-            raise Exception('Unknown ies version {}'.format(int(hdr.version)))
+    if hdr.info_size != ctypes.sizeof(IESColumn) * hdr.col_count_total:
+        raise Exception('Invalid info_size')
 
-        if hdr.info_size != ctypes.sizeof(IESColumn) * hdr.col_count_total:
-            raise Exception('Invalid info_size')
+    if hdr.total_size != ctypes.sizeof(hdr) + hdr.info_size + hdr.data_size:
+        raise Exception('Invalid total_size')
 
-        if hdr.total_size != ctypes.sizeof(hdr) + hdr.info_size + hdr.data_size:
-            raise Exception('Invalid total_size')
+    if hdr.total_size != total_size:
+        raise Exception('total_size does not match file size')
 
-        if hdr.total_size != total_size:
-            raise Exception('total_size does not match file size')
+    return hdr
 
-        cols = [IESColumn(fp) for _ in range(hdr.col_count_total)]
 
+def check_ies(input, use_float=None):
+    report = {'input': input, 'output': None, 'number_width': None, 'errors': []}
+    errors = report['errors']
+    with open(input, 'rb') as fp:
         try:
-            encoding = encoding or 'UTF-8'
-            with open(output, 'w+', encoding=encoding) as fw:
-                xml_start_file = '<?xml version="1.0" encoding="' + encoding + '"?>\n'
-                fw.write(xml_start_file)
-                if encoding == 'UTF-8':
-                    fw.write('<idspace id="{}">'.format(hdr.idspace.decode(encoding)))
-                else:
-                    fw.write('<idspace id="{}">'.format(hdr.idspace.decode("iso-8859-1")))
-                for i in range(hdr.row_count):
+            hdr = read_ies_header(fp)
+        except Exception as e:
+            errors.append(str(e))
+            return report
+
+        if hdr.col_count_total != hdr.col_count_number + hdr.col_count_strings:
+            errors.append('col_count_total does not match number and string column counts')
+
+        cols = [IESColumn(fp) for _ in range(hdr.col_count_total)]
+        number_indices = set()
+        string_indices = set()
+        for col in cols:
+            if col.col_type == COL_TYPE_NUMBER:
+                number_indices.add(col.index)
+            elif col.col_type == COL_TYPE_STRING or col.col_type == COL_TYPE_CALCULATED:
+                string_indices.add(col.index)
+            else:
+                errors.append('Unknown col_type {} in column {}'.format(col.col_type, col.full_name.decode('iso-8859-1')))
+        if number_indices != set(range(hdr.col_count_number)):
+            errors.append('Number column indices are not 0..{}'.format(hdr.col_count_number - 1))
+        if string_indices != set(range(hdr.col_count_strings)):
+            errors.append('String column indices are not 0..{}'.format(hdr.col_count_strings - 1))
+
+        data = fp.read(hdr.data_size)
+        if use_float is None:
+            try:
+                report['number_width'] = detect_number_width(data, hdr)
+            except Exception as e:
+                errors.append(str(e))
+                return report
+        else:
+            report['number_width'] = 4 if use_float else 8
+            error = __scan_rows(data, hdr, report['number_width'])
+            if error is not None:
+                errors.append(error)
+    return report
+
+
+def __struct_fields(struct_type):
+    # Field names of a Struct including the ones inherited from earlier header versions
+    names = []
+    for base in reversed(struct_type.__mro__):
+        names.extend(name for name, _ in base.__dict__.get('_fields_', ()))
+    return names
+
+
+def __row_fields(data, start, end, number_width, number_names, string_names):
+    # (column, value bytes) pairs of one row in storage order
+    class_len = struct.unpack_from('<H', data, start + 4)[0]
+    fields = [('class id', data[start:start + 4]), ('class name', data[start + 6:start + 6 + class_len])]
+    pos = start + 6 + class_len
+    for name in number_names:
+        fields.append((name, data[pos:pos + number_width]))
+        pos += number_width
+    for name in string_names:
+        str_len = struct.unpack_from('<H', data, pos)[0]
+        fields.append((name, xor_str(data[pos + 2:pos + 2 + str_len])))
+        pos += 2 + str_len
+    fields.append(('is_scr', data[pos:end]))
+    return fields
+
+
+def compare_ies(original, rebuilt, number_width):
+    # Describe the first difference between two ies files, header first, then column descriptors, then rows
+    hdr = read_ies_header(io.BytesIO(original))
+    other = type(hdr)(io.BytesIO(rebuilt))
+    for name in __struct_fields(type(hdr)):
+        if getattr(hdr, name) != getattr(other, name):
+            return 'Header {} differs: {!r} != {!r}'.format(name, getattr(hdr, name), getattr(other, name))
+    header_size = ctypes.sizeof(hdr)
+    if original[:header_size] != rebuilt[:header_size]:
+        return 'Header padding bytes differ'
+
+    column_size = ctypes.sizeof(IESColumn)
+    cols = []
+    for i in range(hdr.col_count_total):
+        start = header_size + i * column_size
+        col = IESColumn(io.BytesIO(original[start:start + column_size]))
+        if original[start:start + column_size] != rebuilt[start:start + column_size]:
+            other_col = IESColumn(io.BytesIO(rebuilt[start:start + column_size]))
+            for name in __struct_fields(IESColumn):
+                if getattr(col, name) != getattr(other_col, name):
+                    return 'Column {} ({}) {} differs: {!r} != {!r}'.format(
+                        i, col.full_name.decode('iso-8859-1'), name, getattr(col, name), getattr(other_col, name))
+            return 'Column {} ({}) padding bytes differ'.format(i, col.full_name.decode('iso-8859-1'))
+        cols.append(col)
+
+    number_names = [None] * hdr.col_count_number
+    string_names = [None] * hdr.col_count_strings
+    for col in cols:
+        names = number_names if col.col_type == COL_TYPE_NUMBER else string_names
+        names[col.index] = col.full_name.decode('iso-8859-1')
+
+    data_start = header_size + hdr.info_size
+    data = original[data_start:]
+    other_data = rebuilt[data_start:]
+    offsets = []
+    other_offsets = []
+    error = __scan_rows(data, hdr, number_width, offsets)
+    if error is not None:
+        return 'Original data section: {}'.format(error)
+    error = __scan_rows(other_data, hdr, number_width, other_offsets)
+    if error is not None:
+        return 'Rebuilt data section: {}'.format(error)
+    for row in range(hdr.row_count):
+        fields = __row_fields(data, offsets[row], offsets[row + 1], number_width, number_names, string_names)
+        other_fields = __row_fields(other_data, other_offsets[row], other_offsets[row + 1], number_width,
+                                    number_names, string_names)
+        if fields == other_fields:
+            continue
+        class_id = struct.unpack_from('<I', data, offsets[row])[0]
+        number_format = '<f' if number_width == 4 else '<d'
+        for i, ((name, value), (_, other_value)) in enumerate(zip(fields, other_fields)):
+            if value != other_value:
+                if 2 <= i < 2 + hdr.col_count_number:
+                    value = struct.unpack(number_format, value)[0]
+                    other_value = struct.unpack(number_format, other_value)[0]
+                return 'Row {} (ClassID {}) column {} differs: {!r} != {!r}'.format(
+                    row, class_id, name, value, other_value)
+    return 'Files differ'
+
+
+def verify_roundtrip(input, encoding, use_float=None):
+    # ies -> xml -> ies entirely in memory, the rebuilt file must match the original byte for byte
+    report = {'input': input, 'output': None, 'number_width': None, 'errors': []}
+    errors = report['errors']
+    with open(input, 'rb') as fp:
+        original = fp.read()
+    xml = io.BytesIO()
+    rebuilt = io.BytesIO()
+    try:
+        report['number_width'] = ies_to_xml(io.BytesIO(original), xml, None, None, encoding,
+                                            use_float)['number_width']
+        if xml_to_ies(xml, rebuilt, None, None, encoding, report['number_width'] == 4) is None:
+            errors.append('Could not convert xml back to ies')
+            return report
+        if rebuilt.getvalue() != original:
+            errors.append(compare_ies(original, rebuilt.getvalue(), report['number_width']))
+    except Exception as e:
+        errors.append(str(e))
+    return report
+
+
+__umask = os.umask(0)
+os.umask(__umask)
+
+
+def __temp_file(output):
+    fd, temp_name = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(output)),
+                                     prefix=os.path.basename(output) + '.', suffix='.tmp')
+    # mkstemp creates private files, give it the permissions a plain open() would
+    try:
+        mode = os.stat(output).st_mode & 0o777
+    except OSError:
+        mode = 0o666 & ~__umask
+    os.chmod(temp_name, mode)
+    return fd, temp_name
+
+
+def __same_content(file_name, data):
+    try:
+        if os.path.getsize(file_name) != len(data):
+            return False
+        with open(file_name, 'rb') as fp:
+            return fp.read() == data
+    except OSError:
+        return False
+
+
+def replace_file(temp_name, output, skip_unchanged=False):
+    # Returns False if output already had the same content and was left untouched
+    try:
+        if skip_unchanged and os.path.isfile(output) and filecmp.cmp(temp_name, output, shallow=False):
+            os.remove(temp_name)
+            return False
+        os.replace(temp_name, output)
+        return True
+    except BaseException:
+        with suppress(OSError):
+            os.remove(temp_name)
+        raise
+
+
+def write_file_atomic(output, data, skip_unchanged=False):
+    # Readers never see a partially written file, the old one stays in place until the rename
+    if skip_unchanged and __same_content(output, data):
+        return False
+    fd, temp_name = __temp_file(output)
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data)
+    except BaseException:
+        with suppress(OSError):
+            os.remove(temp_name)
+        raise
+    return replace_file(temp_name, output)
+
+
+def __write_xml(fp, fw, hdr, cols, order, dictionary, encoding, use_float, input):
+    try:
+        xml_start_file = '<?xml version="1.0" encoding="' + encoding + '"?>\n'
+        fw.write(xml_start_file)
+        if encoding == 'UTF-8':
+            fw.write('<idspace id="{}">'.format(hdr.idspace.decode(encoding)))
+        else:
+            fw.write('<idspace id="{}">'.format(hdr.idspace.decode("iso-8859-1")))
+        for i in range(hdr.row_count):
+            try:
+                class_id, class_len = struct.unpack('<IH', fp.read(6))
+            except:
+                class_id, class_len = None, None
+            if encoding == 'UTF-8':
+                if class_len:
                     try:
-                        class_id, class_len = struct.unpack('<IH', fp.read(6))
+                        class_name = fp.read(class_len).decode(encoding)
                     except:
-                        class_id, class_len = None, None
+                        class_name = fp.read(class_len).decode("iso-8859-5")
+                else:
+                    class_name = None
+            else:
+                if class_len:
+                    class_name = fp.read(class_len).decode("iso-8859-1")
+                else:
+                    class_name = None
+            if use_float:
+                numbers = struct.unpack('<{}f'.format(hdr.col_count_number),
+                                        fp.read(4 * hdr.col_count_number))
+            else:
+                try:
+                    numbers = struct.unpack('<{}d'.format(hdr.col_count_number),
+                                            fp.read(8 * hdr.col_count_number))
+                except:
+                    # struct.error: unpack requires a buffer of 8 bytes
+                    numbers = struct.unpack('', fp.read(8 * hdr.col_count_number))
+            strings = []
+            for _ in range(hdr.col_count_strings):
+                try:
+                    str_len = int(struct.unpack('<H', fp.read(2))[0])
+                except:
+                    str_len = struct.unpack('', fp.read(2)) and int(struct.unpack('', fp.read(2))[0])
+                if str_len:
                     if encoding == 'UTF-8':
-                        if class_len:
-                            try:
-                                class_name = fp.read(class_len).decode(encoding)
-                            except:
-                                class_name = fp.read(class_len).decode("iso-8859-5")
-                        else:
-                            class_name = None
-                    else:
-                        if class_len:
-                            class_name = fp.read(class_len).decode("iso-8859-1")
-                        else:
-                            class_name = None
-                    if use_float:
-                        numbers = struct.unpack('<{}f'.format(hdr.col_count_number),
-                                                fp.read(4 * hdr.col_count_number))
-                    else:
                         try:
-                            numbers = struct.unpack('<{}d'.format(hdr.col_count_number),
-                                                    fp.read(8 * hdr.col_count_number))
+                            strings.append(
+                                unescape(xor_str(fp.read(str_len)).decode(encoding)))
                         except:
-                            # struct.error: unpack requires a buffer of 8 bytes
-                            numbers = struct.unpack('', fp.read(8 * hdr.col_count_number))
-                    strings = []
-                    for _ in range(hdr.col_count_strings):
+                            strings.append(
+                                unescape(xor_str(fp.read(str_len)).decode('iso-8859-5')))
+                    else:
+                        strings.append(
+                            unescape(xor_str(fp.read(str_len)).decode("iso-8859-1")))
+                else:
+                    strings.append('None')
+            try:
+                struct.unpack('{}B'.format(hdr.col_count_strings), fp.read(hdr.col_count_strings))  # is_cp
+            except:
+                struct.unpack('', fp.read(hdr.col_count_strings))  # is_cp
+            if dictionary:
+                for i, string in enumerate(strings):
+                    for m in re_localization.finditer(string):
                         try:
-                            str_len = int(struct.unpack('<H', fp.read(2))[0])
-                        except:
-                            str_len = struct.unpack('', fp.read(2)) and int(struct.unpack('', fp.read(2))[0])
-                        if str_len:
-                            if encoding == 'UTF-8':
-                                try:
-                                    strings.append(
-                                        unescape(xor_str(fp.read(str_len)).decode(encoding)))
-                                except:
-                                    strings.append(
-                                        unescape(xor_str(fp.read(str_len)).decode('iso-8859-5')))
-                            else:
-                                strings.append(
-                                    unescape(xor_str(fp.read(str_len)).decode("iso-8859-1")))
-                        else:
-                            strings.append('None')
+                            strings[i] = string.replace(m.group(), dictionary[m.group(1)])
+                        except KeyError:
+                            logging.warning('Missing translation for text id {}'.format(m.group(1)))
+
+            attr = OrderedDict([
+                ('ClassID', str(class_id)),
+                ('ClassName', class_name)
+            ])
+
+            for col in cols:
+                if col.col_type == COL_TYPE_NUMBER:
+                    if numbers:
+                        value = ('%f' % numbers[col.index]).rstrip('0').rstrip('.')
+                    else:
+                        continue
+                elif col.col_type == COL_TYPE_STRING or col.col_type == COL_TYPE_CALCULATED:
+                    value = strings[col.index]
+                else:
+                    raise Exception('Unknown col_type {} in {}'.format(col.col_type, input))
+                if encoding == 'UTF-8':
+                    full_name_decode = col.full_name.decode(encoding)
+                else:
+                    full_name_decode = col.full_name.decode("iso-8859-1")
+                attr[full_name_decode] = value
+
+            fw.write('\n\t<Class ')
+            additional_escape = {'"': '&quot;'}
+            if order:
+                for k in order:
+                    with suppress(KeyError):
+                        if attr[k]:
+                            fw.write('{}="{}" '.format(k, escape(attr[k], additional_escape)))
+                        del attr[k]
+            index = 1
+            for k, v in attr.items():
+                index += 1
+                if v:
                     try:
-                        struct.unpack('{}B'.format(hdr.col_count_strings), fp.read(hdr.col_count_strings))  # is_cp
+                        fw.write('{}="{}" '.format(k,
+                                                   escape(v.encode('iso-8859-1').decode('ksc5601'),
+                                                             additional_escape)))
                     except:
-                        struct.unpack('', fp.read(hdr.col_count_strings))  # is_cp
-                    if dictionary:
-                        for i, string in enumerate(strings):
-                            for m in re_localization.finditer(string):
-                                try:
-                                    strings[i] = string.replace(m.group(), dictionary[m.group(1)])
-                                except KeyError:
-                                    logging.warning('Missing translation for text id {}'.format(m.group(1)))
-
-                    attr = OrderedDict([
-                        ('ClassID', str(class_id)),
-                        ('ClassName', class_name)
-                    ])
-
-                    for col in cols:
-                        if col.col_type == COL_TYPE_NUMBER:
-                            if numbers:
-                                value = ('%f' % numbers[col.index]).rstrip('0').rstrip('.')
-                            else:
-                                continue
-                        elif col.col_type == COL_TYPE_STRING or col.col_type == COL_TYPE_CALCULATED:
-                            value = strings[col.index]
-                        else:
-                            raise Exception('Unknown col_type {} in {}'.format(col.col_type, input))
-                        if encoding == 'UTF-8':
-                            full_name_decode = col.full_name.decode(encoding)
-                        else:
-                            full_name_decode = col.full_name.decode("iso-8859-1")
-                        attr[full_name_decode] = value
-
-                    fw.write('\n\t<Class ')
-                    additional_escape = {'"': '&quot;'}
-                    if order:
-                        for k in order:
-                            with suppress(KeyError):
-                                if attr[k]:
-                                    fw.write('{}="{}" '.format(k, escape(attr[k], additional_escape)))
-                                del attr[k]
-                    index = 1
-                    for k, v in attr.items():
-                        index += 1
-                        if v:
-                            try:
-                                fw.write('{}="{}" '.format(k,
-                                                           escape(v.encode('iso-8859-1').decode('ksc5601'),
-                                                                     additional_escape)))
-                            except:
-                                # UnicodeEncodeError: 'latin-1' codec can't encode characters in position 13-14:
-                                # ordinal not in range(256)
-                                try:
-                                    fw.write('{}="{}" '.format(k,
-                                                               escape(v.encode('iso-8859-5').decode('ksc5601'),
-                                                                         additional_escape)))
-                                except:
-                                    fw.write('{}="{}" '.format(k,
-                                                               escape(v.encode('utf-8').decode('utf-8'),
-                                                                      additional_escape)))
-                    fw.write('/>')
-
-                fw.write('\n</idspace>\n')
-        except UnicodeDecodeError as e:
-            logging.critical('Could not decode string: ', e.object[e.start:e.end])
-        except UnicodeEncodeError as e:
-            logging.critical('Could not encode string: ', e.object[e.start:e.end])
-
-
-def xml_to_ies(input, output, order, dictionary, encoding, use_float):
-    try:
-        if encoding == 'EUC-KR':
-            xmlp = ET.XMLParser(encoding='ksc5601')
-            dom = ET.parse(input, parser=xmlp)
-        else:
-            xmlp = ET.XMLParser(encoding=encoding)
-            dom = ET.parse(input, parser=xmlp)
-    except Exception as e:
+                        # UnicodeEncodeError: 'latin-1' codec can't encode characters in position 13-14:
+                        # ordinal not in range(256)
+                        try:
+                            fw.write('{}="{}" '.format(k,
+                                                       escape(v.encode('iso-8859-5').decode('ksc5601'),
+                                                                 additional_escape)))
+                        except:
+                            fw.write('{}="{}" '.format(k,
+                                                       escape(v.encode('utf-8').decode('utf-8'),
+                                                              additional_escape)))
+            fw.write('/>')
+
+        fw.write('\n</idspace>\n')
+    except UnicodeDecodeError as e:
+        logging.critical('Could not decode string: ', e.object[e.start:e.end])
+    except UnicodeEncodeError as e:
+        logging.critical('Could not encode string: ', e.object[e.start:e.end])
+
+
+def __open_binary(source):
+    # File names are opened, file objects are rewound and used as they are
+    if hasattr(source, 'read'):
+        source.seek(0)
+        return nullcontext(source)
+    return open(source, 'rb')
+
+
+def __display_name(source):
+    if isinstance(source, str):
+        return source
+    name = getattr(source, 'name', None)
+    return name if isinstance(name, str) else '<stream>'
+
+
+def ies_to_xml(input, output, order, dictionary, encoding, use_float=None, skip_unchanged=False):
+    # input and output are file names or binary file objects, an input object must be seekable
+    with __open_binary(input) as fp:
+        hdr = read_ies_header(fp)
+        cols = [IESColumn(fp) for _ in range(hdr.col_count_total)]
+
+        if use_float is None:
+            data_begin = fp.tell()
+            use_float = detect_number_width(fp.read(hdr.data_size), hdr) == 4
+            fp.seek(data_begin, os.SEEK_SET)
+        report = {'input': __display_name(input), 'output': __display_name(output),
+                  'number_width': 4 if use_float else 8}
+        encoding = encoding or 'UTF-8'
+
+        if hasattr(output, 'write'):
+            fw = io.TextIOWrapper(output, encoding=encoding)
+            try:
+                __write_xml(fp, fw, hdr, cols, order, dictionary, encoding, use_float, input)
+            finally:
+                fw.detach()
+            report['written'] = True
+            return report
+
+        fd, temp_name = __temp_file(output)
         try:
-            encoding = 'iso-8859-5'
-            xmlp = ET.XMLParser(encoding='iso-8859-5')
-            dom = ET.parse(input, parser=xmlp)
-        except Exception as e:
-            return
+            with open(fd, 'w+', encoding=encoding) as fw:
+                __write_xml(fp, fw, hdr, cols, order, dictionary, encoding, use_float, input)
+        except BaseException:
+            with suppress(OSError):
+                os.remove(temp_name)
+            raise
 
-    root = dom.getroot()
+    report['written'] = replace_file(temp_name, output, skip_unchanged)
+    return report
 
-    fields = list(root.findall('.//Class'))
 
-    # In case this is localized file - load class from main file and use it's data to fill in rest of the table.
-    # Also insert ClassSchema
+def __original_file_name(input):
+    # Localized files live in a 3-letter locale directory next to the main file
     if len(os.path.basename(os.path.dirname(input))) == 3:
         original_file_name = os.path.join(os.path.dirname(os.path.dirname(input)), os.path.basename(input))
         if os.path.isfile(original_file_name):
-            dom_main = ElementTree.parse(original_file_name)
-            root_main = dom_main.getroot()
-            # These attributes must match main file so copy them over
-            if 'module' in root_main.attrib:
-                root.attrib['module'] = root_main.attrib['module']
-            if 'module_prefix' in root_main.attrib:
-                root.attrib['module_prefix'] = root_main.attrib['module_prefix']
-            schema = root_main.find('./Schema')
-            if schema is not None:
-                root.append(schema)
-            # Fill in missing fields from base class
-            for cls in fields:
-                class_id = cls.get('ClassID')
-                if class_id:
-                    orig_cls = root_main.find(f'./Class[@ClassID="{class_id}"]')
-                else:
-                    class_name = cls.get('ClassName')
-                    orig_cls = root_main.find(f'./Class[@ClassName="{class_name}"]')
-                if orig_cls is not None:
-                    for k, v in orig_cls.attrib.items():
-                        if k not in cls.attrib:
-                            cls.attrib[k] = v
+            return original_file_name
+    return None
+
 
-    module_space = root.attrib.get('module')
-    module_prefix = root.attrib.get('module_prefix')
+def sniff_xml_encoding(head):
+    # Encoding from the byte order mark or the xml declaration, xml default otherwise
+    if head.startswith(codecs.BOM_UTF8):
+        return 'UTF-8'
+    if head.startswith(codecs.BOM_UTF16_LE) or head.startswith(codecs.BOM_UTF16_BE):
+        return 'UTF-16'
+    m = re_xml_declaration.match(head)
+    return m.group(1).decode('ascii').upper() if m else 'UTF-8'
+
+
+def __expat_encoding(encoding):
+    return 'ksc5601' if encoding == 'EUC-KR' else encoding
+
+
+def __parser_accepts(encoding):
+    # expat only handles single-byte encodings besides UTF-8/UTF-16
+    if xml_backend() == 'lxml':
+        return True
+    try:
+        ET.XMLParser(encoding=__expat_encoding(encoding)).feed(b'<a/>')
+    except (ET.ParseError, LookupError, ValueError):
+        return False
+    return True
+
+
+def __same_encoding(a, b):
+    try:
+        return codecs.lookup(a).name == codecs.lookup(b).name
+    except LookupError:
+        return False
+
+
+def detect_xml_encoding(input, encoding):
+    # Pick the encoding once up front from the BOM or xml declaration, the file itself is not decoded. A requested
+    # encoding other than the declared one, or one the backend cannot take, reads the file as iso-8859-5: it maps
+    # every byte to a character and back, so the strings pass through to the ies byte for byte.
+    with __open_binary(input) as fp:
+        declared = sniff_xml_encoding(fp.read(1024))
+    if encoding is None:
+        encoding = declared
+    elif not __same_encoding(encoding, declared):
+        return 'iso-8859-5'
+    if not __parser_accepts(encoding):
+        return 'iso-8859-5'
+    return encoding
+
+
+def parse_xml(file_name, encoding=None):
+    # Whole tree with the selected parser backend, both have the ElementTree find/iterfind/attrib interface
+    if xml_backend() == 'lxml':
+        parser = lxml_etree.XMLParser(encoding=encoding, huge_tree=True)
+        return lxml_etree.parse(file_name, parser).getroot()
+    return ET.parse(file_name, parser=ET.XMLParser(encoding=__expat_encoding(encoding))).getroot()
+
+
+def __iterparse(input, encoding):
+    # Every pass reads the whole document, file objects are rewound first
+    if hasattr(input, 'seek'):
+        input.seek(0)
+    if xml_backend() == 'lxml':
+        yield from lxml_etree.iterparse(input, events=('start', 'end'), encoding=encoding, huge_tree=True,
+                                        remove_comments=True, remove_pis=True)
+        return
+    parser = ET.XMLParser(encoding=__expat_encoding(encoding))
+    yield from ET.iterparse(input, events=('start', 'end'), parser=parser)
+
+
+def __iter_xml(input, encoding):
+    # Stream (kind, attrib) pairs for the root, its ClassSchema and every Class, dropping elements once seen
+    # so memory does not grow with the number of rows
+    stack = []
+    for event, elem in __iterparse(input, encoding):
+        if event == 'start':
+            if not stack:
+                yield 'root', dict(elem.attrib)
+            stack.append(elem)
+            continue
+        stack.pop()
+        if elem.tag == 'Class':
+            yield 'class', dict(elem.attrib)
+        elif elem.tag == 'ClassSchema' and len(stack) == 2 and stack[1].tag == 'Schema':
+            yield 'schema', dict(elem.attrib)
+        if stack:
+            stack[-1].remove(elem)
+
+
+def value_type(value):
+    # Column type a value votes for in inference
+    if value.isdigit() and value.isascii() or re_number.match(value.strip()) is not None:
+        return COL_TYPE_NUMBER
+    return COL_TYPE_STRING
+
+
+def schema_column_type(col_name, column_schema):
+    schema_type = column_schema.get(col_name)
+    if schema_type is not None:
+        if schema_type == 'STRING':
+            return COL_TYPE_STRING
+        elif schema_type == 'NUMBER':
+            return COL_TYPE_NUMBER
+        elif schema_type == 'CALCULATED':
+            return COL_TYPE_CALCULATED
+        else:
+            raise Exception('Invalid ClassSchema')
+    if col_name.startswith('CP_'):
+        return COL_TYPE_CALCULATED
+    return None
+
+
+class XMLColumns(object):
+    """Column layout of an xml datatable collected in a single streaming pass."""
+
+    def __init__(self):
+        self.root = {}
+        self.schema = None
+        self.encoding = None
+        self.value_types = OrderedDict()
+        self.mismatch = {}
+        self.settled = set()
+        self.row_count = 0
+        self.with_class_id = 0
+        # Encoded bytes of every column and of ClassName over all rows, so the ies data size is known before
+        # the rows are packed
+        self.value_sizes = {}
+        self.class_name_size = 0
+
+    def __encoded_size(self, value):
+        if value.isascii() and self.ascii_compatible:
+            return len(value)
+        # Values that do not encode fail later in the encoding pass, with its error message
+        return len(value.encode(self.encoding, 'replace'))
+
+    def add_class(self, attrib):
+        self.row_count += 1
+        if 'ClassID' in attrib:
+            self.with_class_id += 1
+        value_types = self.value_types
+        settled = self.settled
+        value_sizes = self.value_sizes
+        self.class_name_size += self.__encoded_size(attrib.get('ClassName', ''))
+        for col_name, value in attrib.items():
+            if value != 'None':
+                value_sizes[col_name] = value_sizes.get(col_name, 0) + self.__encoded_size(value)
+            # Columns typed by schema or CP_ prefix and columns already proven mixed need no more values
+            if col_name in settled:
+                continue
+            column_type = value_type(value)
+            seen = value_types.get(col_name)
+            if seen is None:
+                value_types[col_name] = column_type
+                if col_name.startswith('CP_') or (self.schema is not None and col_name in self.schema):
+                    settled.add(col_name)
+            elif seen != column_type:
+                self.mismatch[col_name] = attrib.get('ClassID', -1)
+                settled.add(col_name)
+
+    def column_types(self, column_schema):
+        # Schema and CP_ prefix win over the values; otherwise all values of a column must agree
+        result = OrderedDict()
+        for col_name, value_type in self.value_types.items():
+            column_type = schema_column_type(col_name, column_schema)
+            if column_type is None:
+                if col_name in self.mismatch:
+                    raise Exception('Column {} type mismatch in ClassID={}. Add ClassSchema entry.'.format(
+                        col_name, self.mismatch[col_name]))
+                column_type = value_type
+            result[col_name] = column_type
+        return result
+
+    @property
+    def encoding(self):
+        return self.__encoding
+
+    @encoding.setter
+    def encoding(self, encoding):
+        self.__encoding = encoding
+        self.ascii_compatible = encoding is not None and 'ascii'.encode(encoding) == b'ascii'
+
+    def data_size(self, columns_number, columns_string, number_width):
+        # Size of the ies data section __encode_row produces for the collected rows
+        row_size = 6 + number_width * len(columns_number) + 3 * len(columns_string)
+        return (self.row_count * row_size + self.class_name_size +
+                sum(self.value_sizes.get(col_name, 0) for col_name in columns_string))
+
+    def save(self, file_name, digest):
+        data = {
+            'digest': digest,
+            'idspace': self.root.get('id'),
+            'root': self.root,
+            'schema': self.schema,
+            'encoding': self.encoding,
+            'value_types': list(self.value_types.items()),
+            'mismatch': self.mismatch,
+            'row_count': self.row_count,
+            'with_class_id': self.with_class_id,
+            'value_sizes': self.value_sizes,
+            'class_name_size': self.class_name_size,
+        }
+        with suppress(OSError):
+            with open(file_name, 'w', encoding='utf-8') as fp:
+                json.dump(data, fp)
+
+    @staticmethod
+    def load(file_name, digest):
+        try:
+            with open(file_name, encoding='utf-8') as fp:
+                data = json.load(fp)
+        except (OSError, ValueError):
+            return None
+        if data.get('digest') != digest or 'value_sizes' not in data:
+            return None
+        columns = XMLColumns()
+        columns.root = data['root']
+        columns.schema = data['schema']
+        columns.encoding = data['encoding']
+        columns.value_types = OrderedDict((k, v) for k, v in data['value_types'])
+        columns.mismatch = data['mismatch']
+        columns.row_count = data['row_count']
+        columns.with_class_id = data['with_class_id']
+        columns.value_sizes = data['value_sizes']
+        columns.class_name_size = data['class_name_size']
+        return columns
+
+
+def __file_digest(file_name, digest=None):
+    digest = digest or hashlib.sha1()
+    with open(file_name, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest
+
+
+class XMLIndex(object):
+    """Attributes of a main datatable indexed by ClassID and ClassName for merging localized files."""
+
+    def __init__(self, file_name):
+        start_time = time.perf_counter()
+        self.file_name = file_name
+        root = parse_xml(file_name)
+        self.root = dict(root.attrib)
+        schema = root.find('./Schema/ClassSchema')
+        self.schema = dict(schema.attrib) if schema is not None else None
+        self.by_class_id = {}
+        self.by_class_name = {}
+        for cls in root.iterfind('./Class'):
+            attrib = dict(cls.attrib)
+            if 'ClassID' in attrib:
+                self.by_class_id.setdefault(attrib['ClassID'], attrib)
+            if 'ClassName' in attrib:
+                self.by_class_name.setdefault(attrib['ClassName'], attrib)
+        self.parse_time = time.perf_counter() - start_time
+
+    def merge(self, attrib):
+        # Fill in missing fields from base class
+        class_id = attrib.get('ClassID')
+        if class_id:
+            orig_attrib = self.by_class_id.get(class_id)
+        else:
+            orig_attrib = self.by_class_name.get(attrib.get('ClassName'))
+        if orig_attrib is None:
+            return attrib
+        merged = dict(attrib)
+        for k, v in orig_attrib.items():
+            if k not in merged:
+                merged[k] = v
+        return merged
+
+
+__original_cache = {}
+# Queued inputs per main file that have not been converted yet
+__original_pending = {}
+__original_lock = threading.Lock()
+
+
+def __queue_original(input):
+    # Several locales share the same main file, its index is kept until the last of them is done
+    original_file_name = __original_file_name(input)
+    if original_file_name is None:
+        return
+    path = os.path.abspath(original_file_name)
+    with __original_lock:
+        __original_pending[path] = __original_pending.get(path, 0) + 1
+
+
+def __release_original(input):
+    original_file_name = __original_file_name(input)
+    if original_file_name is None:
+        return
+    path = os.path.abspath(original_file_name)
+    with __original_lock:
+        pending = __original_pending.get(path, 0) - 1
+        if pending > 0:
+            __original_pending[path] = pending
+        else:
+            __original_pending.pop(path, None)
+            __original_cache.pop(path, None)
+
+
+def __load_original(original_file_name):
+    # Parsed once for all queued inputs sharing the main file, a file nobody queued is parsed on each call
+    if original_file_name is None:
+        return None
+    path = os.path.abspath(original_file_name)
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    with __original_lock:
+        if path not in __original_pending:
+            entry = (stamp, threading.Lock(), [])
+        else:
+            entry = __original_cache.get(path)
+            if entry is None or entry[0] != stamp:
+                entry = __original_cache[path] = (stamp, threading.Lock(), [])
+    _, lock, index = entry
+    with lock:
+        if not index:
+            index.append(XMLIndex(path))
+    return index[0]
+
+
+def __collect_columns(input, encoding, main_index, on_class=None):
+    columns = XMLColumns()
+    columns.encoding = encoding
+    for kind, attrib in __iter_xml(input, encoding):
+        if kind == 'class':
+            if main_index is not None:
+                attrib = main_index.merge(attrib)
+            columns.add_class(attrib)
+            if on_class is not None:
+                on_class(attrib)
+        elif kind == 'schema':
+            if columns.schema is None:
+                columns.schema = dict(attrib)
+        else:
+            columns.root = attrib
+    if main_index is not None:
+        # These attributes must match main file so copy them over
+        for k in ('module', 'module_prefix'):
+            if k in main_index.root:
+                columns.root[k] = main_index.root[k]
+        if columns.schema is None:
+            columns.schema = main_index.schema
+    return columns
+
+
+def check_xml(input, encoding):
+    report = {'input': input, 'output': None, 'number_width': None, 'errors': []}
+    errors = report['errors']
+
+    def check_class(attrib):
+        class_id = attrib.get('ClassID')
+        if class_id is not None and not class_id.isdigit():
+            errors.append('Invalid ClassID {}'.format(class_id))
+        for col_name, value in attrib.items():
+            try:
+                if len(value.encode(encoding)) > 0xFFFF:
+                    errors.append('Column {} value too long in ClassID={}'.format(col_name, class_id))
+            except UnicodeEncodeError:
+                errors.append('Column {} value not encodable as {} in ClassID={}'.format(
+                    col_name, encoding, class_id))
+
+    try:
+        main_index = __load_original(__original_file_name(input))
+    except Exception as e:
+        errors.append('Could not parse main xml: {}'.format(e))
+        return report
+    try:
+        encoding = detect_xml_encoding(input, encoding)
+        columns = __collect_columns(input, encoding, main_index, check_class)
+    except Exception:
+        errors.append('Could not parse xml')
+        return report
+
+    if 'id' not in columns.root:
+        errors.append('Root element has no id attribute')
+    for col_name, schema_type in (columns.schema or {}).items():
+        if schema_type not in ('STRING', 'NUMBER', 'CALCULATED'):
+            errors.append('Invalid ClassSchema type {} for column {}'.format(schema_type, col_name))
+            return report
+    try:
+        columns.column_types(columns.schema or {})
+    except Exception as e:
+        errors.append(str(e))
+    if columns.with_class_id and columns.with_class_id != columns.row_count:
+        errors.append('All classes either must have ClassID or must not have it.')
+    if columns.row_count > 0xFFFF:
+        errors.append('Too many rows ({})'.format(columns.row_count))
+    return report
+
+
+__string_len = struct.Struct('<H')
+__row_head = struct.Struct('<IH')
+
+
+def __encode_row(attrib, columns_number, columns_string, encoding, use_float):
+    # Returns the packed row
+    class_name = xor_str(attrib.get('ClassName', '').encode(encoding))
+    numbers = array.array('f' if use_float else 'd',
+                          [float(attrib.get(col_name, 0.0)) for col_name in columns_number])
+    if sys.byteorder != 'little':
+        numbers.byteswap()
+    numbers = numbers.tobytes()
+
+    # String section is XORed in one go, lengths are stored pre-XORed so the translate restores them
+    pack_len = __string_len.pack
+    strings = []
+    is_scr = []
+    for col_name in columns_string:
+        value = attrib.get(col_name, '')
+        if value == 'None':
+            value = b''
+            is_scr.append(False)
+        else:
+            is_scr.append(value.startswith('SCP_') or value.startswith('SCR_'))
+            value = value.encode(encoding)
+        strings.append(pack_len(len(value) ^ 0x0101))
+        strings.append(value)
+    strings = xor_str(b''.join(strings))
+
+    return b''.join((__row_head.pack(int(attrib.get('ClassID', 0)), len(class_name)), class_name, numbers, strings,
+                     bytes(is_scr)))
+
+
+def __xml_columns(input, encoding, main_index, rows=None):
+    # First pass - detect columns and their types, optionally keeping the rows
+    on_class = rows.append if rows is not None else None
+    try:
+        return __collect_columns(input, detect_xml_encoding(input, encoding), main_index, on_class)
+    except Exception as e:
+        logging.error('{}: {}'.format(__display_name(input), e))
+        return None
+
+
+def __iter_rows(input, encoding, main_index):
+    for kind, attrib in __iter_xml(input, encoding):
+        if kind != 'class':
+            continue
+        if main_index is not None:
+            attrib = main_index.merge(attrib)
+        yield attrib
+
+
+def __build_header(xml_columns):
+    encoding = xml_columns.encoding
+    root_attrib = xml_columns.root
+    module_space = root_attrib.get('module')
+    module_prefix = root_attrib.get('module_prefix')
 
     if module_prefix:
         hdr = IESHeader3()
@@ -371,118 +1201,374 @@ def xml_to_ies(input, output, order, dictionary, encoding, use_float):
         hdr = IESHeader()
         hdr.version = 1
 
-    hdr.idspace = root.attrib['id'].encode(encoding)
-    hdr.has_class_id = all(['ClassID' in cls.attrib for cls in fields])
+    hdr.idspace = root_attrib['id'].encode(encoding)
+    hdr.has_class_id = xml_columns.with_class_id == xml_columns.row_count
     if not hdr.has_class_id:
-        if any(['ClassID' in cls.attrib for cls in fields]):
+        if xml_columns.with_class_id:
             raise Exception('All classes either must have ClassID or must not have it.')
 
     columns_number = []
     columns_string = []
     columns = {}
 
-    column_schema = root.find('./Schema/ClassSchema')
-    if column_schema is not None:
-        column_schema = column_schema.attrib
-    else:
-        column_schema = {}
-
-    # Create columns and detect their types
-    hdr.row_count = len(fields)
-    string_data_size = 0
+    # Create columns
+    hdr.row_count = xml_columns.row_count
     hdr.col_count_total = 0
     hdr.col_count_number = 0
     hdr.col_count_strings = 0
-    for cls in fields:
-        for col_name, value in cls.attrib.items():
-            col = columns.get(col_name)
-
-            schema_type = column_schema.get(col_name)
-            if schema_type is not None:
-                if schema_type == 'STRING':
-                    column_type = COL_TYPE_STRING
-                elif schema_type == 'NUMBER':
-                    column_type = COL_TYPE_NUMBER
-                elif schema_type == 'CALCULATED':
-                    column_type = COL_TYPE_CALCULATED
-                else:
-                    raise Exception('Invalid ClassSchema')
-            else:
-                if col_name.startswith('CP_'):
-                    column_type = COL_TYPE_CALCULATED
-                elif re_number.match(value.strip()) is not None:
-                    column_type = COL_TYPE_NUMBER
-                else:
-                    column_type = COL_TYPE_STRING
-
-            if col is None:
-                col = IESColumn()
-                col.full_name = xor_str(col_name.encode(encoding))
-                col.is_static = col_name.startswith('SP_')
-                col.col_type = column_type
-                if col_name.startswith('SP_') or col_name.startswith('CP_'):
-                    col.column_name = xor_str(col_name[3:].encode(encoding))
-                else:
-                    col.column_name = xor_str(col_name.encode(encoding))
+    for col_name, column_type in xml_columns.column_types(xml_columns.schema or {}).items():
+        col = IESColumn()
+        col.full_name = xor_str(col_name.encode(encoding))
+        col.is_static = col_name.startswith('SP_')
+        col.col_type = column_type
+        if col_name.startswith('SP_') or col_name.startswith('CP_'):
+            col.column_name = xor_str(col_name[3:].encode(encoding))
+        else:
+            col.column_name = xor_str(col_name.encode(encoding))
 
-                hdr.col_count_total += 1
-                if col.col_type == COL_TYPE_NUMBER:
-                    col.index = hdr.col_count_number
-                    hdr.col_count_number += 1
-                    columns_number.append(col_name)
-                else:
-                    col.index = hdr.col_count_strings
-                    hdr.col_count_strings += 1
-                    columns_string.append(col_name)
-                    string_data_size += 2 + len(value.encode(encoding))
+        hdr.col_count_total += 1
+        if col.col_type == COL_TYPE_NUMBER:
+            col.index = hdr.col_count_number
+            hdr.col_count_number += 1
+            columns_number.append(col_name)
+        else:
+            col.index = hdr.col_count_strings
+            hdr.col_count_strings += 1
+            columns_string.append(col_name)
 
-                columns[col_name] = col
-            else:
-                if col.col_type != column_type:
-                    raise Exception('Column {} type mismatch in {} ClassID={}. Add ClassSchema entry.'.format(
-                        cls.attrib.get('ClassID', -1), col_name, os.path.basename(input)))
+        columns[col_name] = col
 
     hdr.info_size = ctypes.sizeof(IESColumn) * hdr.col_count_total
 
     assert hdr.col_count_total == hdr.col_count_number + hdr.col_count_strings
 
-    with open(output, 'w+b') as fp:
-        # ef = ET.fromstring(f.read())
-        fp.write(ctypes.string_at(ctypes.addressof(hdr), ctypes.sizeof(hdr)))
+    return hdr, columns, columns_number, columns_string
+
+
+def __pack_ies(hdr, columns, rows, data_size=None):
+    # Rows are packed row bytes. With a known data_size they can come from a generator and are copied into the
+    # buffer one at a time, so only the output is ever held in memory.
+    if data_size is None:
+        rows = list(rows)
+        data_size = sum(len(row) for row in rows)
+    hdr.data_size = data_size
+    hdr.total_size = ctypes.sizeof(hdr) + hdr.info_size + hdr.data_size
+
+    # Pack everything into a single preallocated buffer
+    data = bytearray(hdr.total_size)
+    pos = ctypes.sizeof(hdr)
+    data[:pos] = ctypes.string_at(ctypes.addressof(hdr), pos)
+    for col in columns.values():
+        data[pos:pos + ctypes.sizeof(col)] = ctypes.string_at(ctypes.addressof(col), ctypes.sizeof(col))
+        pos += ctypes.sizeof(col)
+
+    for row in rows:
+        end = pos + len(row)
+        if end > hdr.total_size:
+            raise Exception('Rows do not fit the measured data size')
+        data[pos:end] = row
+        pos = end
+    if pos != hdr.total_size:
+        raise Exception('Rows do not fill the measured data size')
+    return data
+
+
+def xml_to_ies(input, output, order, dictionary, encoding, use_float, schema_cache=False, skip_unchanged=False):
+    # input and output are file names or binary file objects, an input object must be seekable.
+    # The main file lookup and the schema cache only apply to file names.
+    stream = not isinstance(input, str)
 
-        for col in columns.values():
-            fp.write(ctypes.string_at(ctypes.addressof(col), ctypes.sizeof(col)))
+    # In case this is localized file - load class from main file and use it's data to fill in rest of the table.
+    # Also use its ClassSchema
+    main_index = None if stream else __load_original(__original_file_name(input))
+
+    # Column layout of an unchanged file is taken from its sidecar cache
+    xml_columns = None
+    schema_cache = schema_cache and not stream
+    if schema_cache:
+        # The encoding picked for the file depends on what the backend can decode, so both are part of the key
+        digest = __file_digest(input, hashlib.sha1('{}:{}'.format(xml_backend(), encoding).encode()))
+        if main_index is not None:
+            digest = __file_digest(main_index.file_name, digest)
+        digest = digest.hexdigest()
+        xml_columns = XMLColumns.load(input + '.schema', digest)
+    schema_cached = xml_columns is not None
+
+    if xml_columns is None:
+        xml_columns = __xml_columns(input, encoding, main_index)
+        if xml_columns is None:
+            return
+        if schema_cache:
+            xml_columns.save(input + '.schema', digest)
+    encoding = xml_columns.encoding
 
-        data_begin = fp.tell()
-        for j, cls in enumerate(fields):
-            class_name = cls.attrib.get('ClassName', '')
-            fp.write(struct.pack('IH', int(cls.attrib.get('ClassID', 0)), len(class_name)))
-            if class_name:
-                fp.write(xor_str(class_name.encode(encoding)))
+    hdr, columns, columns_number, columns_string = __build_header(xml_columns)
 
-            for col_name in columns_number:
-                fp.write(struct.pack('f' if use_float else 'd', float(cls.attrib.get(col_name, 0.0))))
+    # Second pass - encode rows straight into the output buffer
+    rows = (__encode_row(attrib, columns_number, columns_string, encoding, use_float)
+            for attrib in __iter_rows(input, encoding, main_index))
+    data = __pack_ies(hdr, columns, rows, xml_columns.data_size(columns_number, columns_string,
+                                                               4 if use_float else 8))
 
-            is_scr = [False] * hdr.col_count_strings
-            for i, col_name in enumerate(columns_string):
-                value = cls.get(col_name, '')
-                if value == 'None':
-                    value = ''
-                else:
-                    is_scr[i] = value.startswith('SCP_') or value.startswith('SCR_')
-                value = value.encode(encoding)
-                fp.write(struct.pack('H', len(value)))
-                if value:
-                    fp.write(xor_str(value))
+    if hasattr(output, 'write'):
+        output.write(data)
+        written = True
+    else:
+        written = write_file_atomic(output, data, skip_unchanged)
+        if written and not stream:
+            os.utime(output, (-1, os.path.getmtime(input)))
+
+    report = {'input': __display_name(input), 'output': __display_name(output),
+              'number_width': 4 if use_float else 8, 'schema_cached': schema_cached, 'written': written}
+    if main_index is not None:
+        report['original'] = main_index.file_name
+        report['original_parse_time'] = main_index.parse_time
+    return report
+
+
+def __class_body(data):
+    # Start of the first and end of the last Class tag, None unless everything between them is self-closing
+    # Class tags and whitespace. '<' can not appear in attribute values, so counting it is enough.
+    first = re_class_tag.search(data)
+    if first is None:
+        return None
+    # Skip a ClassSchema tag after the rows
+    pos = len(data)
+    while True:
+        pos = data.rfind(b'<Class', first.start(), pos)
+        last = re_class_tag.match(data, pos)
+        if last is not None:
+            break
+        if re_class_open.match(data, pos):
+            return None
+    start, end = first.start(), last.end()
+    tags = data.count(b'<', start, end)
+    if data.count(b'<Class', start, end) != tags or re_class_other.search(data, start, end) is not None:
+        return None
+    return start, end, tags
+
+
+def __raw_tags(data, start, end):
+    # Self-closing Class tags of data[start:end], None if there is anything but whitespace around them
+    tags = []
+    pos = start
+    for m in re_class_tag.finditer(data, start, end):
+        if data[pos:m.start()].strip():
+            return None
+        tags.append(m.group())
+        pos = m.end()
+    if data[pos:end].strip():
+        return None
+    return tags
+
+
+def __common_prefix(a, b, limit):
+    # Length of the common prefix of a and b, narrowed down with slice compares so the bytes are walked in C
+    lo, hi = 0, limit
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
 
-            fp.write(struct.pack('B' * len(is_scr), *is_scr))
 
-        hdr.data_size = fp.tell() - data_begin
-        hdr.total_size = ctypes.sizeof(hdr) + hdr.info_size + hdr.data_size
-        fp.seek(0, os.SEEK_SET)
-        fp.write(ctypes.string_at(ctypes.addressof(hdr), ctypes.sizeof(hdr)))
+def __common_suffix(a, b, limit):
+    lo, hi = 0, limit
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[len(a) - mid:len(a) - lo] == b[len(b) - mid:len(b) - lo]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def __raw_attrib(tag, encoding):
+    return ET.fromstring(tag.decode(__expat_encoding(encoding))).attrib
+
+
+def __patch_raw(previous, input, encoding, use_float, old_hdr, old_data, offsets):
+    # Fast patch that parses only the changed rows. The new xml must differ from the previous one only in Class
+    # tags edited in place with the same attributes in the same order, or appended ones using existing columns,
+    # with values of the type their column already has. Column inference then comes out as it did for the
+    # existing ies, so its header and columns are reused as they are. None when that does not hold.
+    with open(previous, 'rb') as fp:
+        old_xml = fp.read()
+    with open(input, 'rb') as fp:
+        new_xml = fp.read()
+    encoding = detect_xml_encoding(input, encoding)
+    if detect_xml_encoding(previous, encoding) != encoding or \
+            '<Class'.encode(__expat_encoding(encoding)) != b'<Class':
+        return None
+    old_body = __class_body(old_xml)
+    new_body = __class_body(new_xml)
+    if old_body is None or new_body is None or old_body[2] != old_hdr.row_count or new_body[2] > 0xFFFF:
+        return None
+
+    # Changed bytes widened to whole tags, the tags on either side are the same in both files
+    prefix = __common_prefix(old_xml, new_xml, min(old_body[1], new_body[1]))
+    suffix = __common_suffix(old_xml, new_xml, min(len(old_xml), len(new_xml)) - prefix)
+    if prefix < old_body[0] or len(old_xml) - suffix > old_body[1] or len(new_xml) - suffix > new_body[1]:
+        # The root element, schema or the end of the file changed
+        return None
+    start = old_xml.rfind(b'<', 0, prefix + 1)
+    old_end = old_xml.find(b'<', len(old_xml) - suffix, old_body[1])
+    old_end = old_body[1] if old_end < 0 else old_end
+    new_end = new_xml.find(b'<', len(new_xml) - suffix, new_body[1])
+    new_end = new_body[1] if new_end < 0 else new_end
+    old_tags = __raw_tags(old_xml, start, old_end)
+    new_tags = __raw_tags(new_xml, start, new_end)
+    if old_tags is None or new_tags is None or len(new_tags) < len(old_tags):
+        return None
+    if len(new_tags) > len(old_tags) and (old_end != old_body[1] or new_end != new_body[1]):
+        # Rows were inserted before other rows
+        return None
+    first = old_xml.count(b'<', old_body[0], start)
+
+    schema_tag = re_class_schema_tag.search(old_xml, 0, old_body[0]) or \
+        re_class_schema_tag.search(old_xml, old_body[1])
+    schema = __raw_attrib(schema_tag.group(), encoding) if schema_tag is not None else {}
+
+    info_begin = ctypes.sizeof(old_hdr)
+    data_begin = info_begin + old_hdr.info_size
+    columns = OrderedDict()
+    column_types = {}
+    number_columns = []
+    string_columns = []
+    for pos in range(info_begin, data_begin, ctypes.sizeof(IESColumn)):
+        col = IESColumn.from_buffer_copy(old_data, pos)
+        col_name = xor_str(col.full_name).decode(encoding)
+        columns[col_name] = col
+        if schema_column_type(col_name, schema) is None:
+            column_types[col_name] = col.col_type
+        (number_columns if col.col_type == COL_TYPE_NUMBER else string_columns).append((col.index, col_name))
+    columns_number = [col_name for _, col_name in sorted(number_columns)]
+    columns_string = [col_name for _, col_name in sorted(string_columns)]
+
+    # Unchanged runs before and after the window are copied in one piece each
+    old_view = memoryview(old_data)[data_begin:]
+    rows = [old_view[:offsets[first]]]
+    changed = 0
+    for i, tag in enumerate(new_tags):
+        if i < len(old_tags) and tag == old_tags[i]:
+            rows.append(old_view[offsets[first + i]:offsets[first + i + 1]])
+            continue
+        attrib = __raw_attrib(tag, encoding)
+        if i < len(old_tags):
+            if list(attrib) != list(__raw_attrib(old_tags[i], encoding)):
+                return None
+        elif 'ClassID' not in attrib or any(col_name not in columns for col_name in attrib):
+            return None
+        for col_name, value in attrib.items():
+            column_type = column_types.get(col_name)
+            if column_type is not None and value_type(value) != column_type:
+                return None
+        rows.append(__encode_row(attrib, columns_number, columns_string, encoding, use_float))
+        changed += 1
+    rows.append(old_view[offsets[first + len(old_tags)]:])
+
+    hdr = type(old_hdr).from_buffer_copy(old_data[:info_begin])
+    hdr.row_count = new_body[2]
+    return hdr, columns, rows, changed
+
+
+def patch_ies(previous, input, output, encoding, use_float=None, skip_unchanged=False):
+    # Re-encode only rows that differ between previous and new xml and copy the rest from the existing ies.
+    # In-place edits and appended rows are found on the raw Class tags, anything else diffs the parsed rows by
+    # ClassID. Anything that changes the column layout falls back to a full xml_to_ies rebuild.
+    def rebuild(reason):
+        logging.info('Rebuilding {}: {}'.format(output, reason))
+        report = xml_to_ies(input, output, None, None, encoding, use_float, skip_unchanged=skip_unchanged)
+        if report is not None:
+            report['patched'] = None
+        return report
+
+    try:
+        with open(output, 'rb') as fp:
+            old_hdr = read_ies_header(fp)
+            fp.seek(0, os.SEEK_SET)
+            old_data = fp.read()
+        info_begin = ctypes.sizeof(old_hdr)
+        data_begin = info_begin + old_hdr.info_size
+        # Row offset index of the existing data section. Keep its number width, also when falling back to a
+        # rebuild.
+        offsets = []
+        if use_float is None:
+            use_float = detect_number_width(memoryview(old_data)[data_begin:], old_hdr, offsets) == 4
+    except Exception as e:
+        return rebuild('no valid existing ies: {}'.format(e))
+    if not offsets and __scan_rows(memoryview(old_data)[data_begin:], old_hdr, 4 if use_float else 8,
+                                   offsets) is not None:
+        return rebuild('ies rows do not match number width')
+
+    # Rows of localized files also depend on their main file, which the raw tags do not show
+    main_index = __load_original(__original_file_name(input))
+    patched = None
+    if main_index is None and old_hdr.has_class_id:
+        try:
+            patched = __patch_raw(previous, input, encoding, use_float, old_hdr, old_data, offsets)
+        except Exception as e:
+            logging.info('{}: raw patch failed, diffing parsed rows: {}'.format(output, e))
+    if patched is not None:
+        hdr, columns, rows, changed = patched
+    else:
+        new_rows = []
+        new_columns = __xml_columns(input, encoding, main_index, new_rows)
+        if new_columns is None:
+            return rebuild('xml not parsed')
+        encoding = new_columns.encoding
+
+        hdr, columns, columns_number, columns_string = __build_header(new_columns)
+        if not hdr.has_class_id:
+            return rebuild('rows have no ClassID')
+
+        # Everything but row count and sizes must already match what a rebuild would write, so the existing ies
+        # has the same idspace attributes and column layout as the new xml
+        expected_hdr = type(hdr).from_buffer_copy(ctypes.string_at(ctypes.addressof(hdr), ctypes.sizeof(hdr)))
+        expected_hdr.row_count = old_hdr.row_count
+        expected_hdr.data_size = old_hdr.data_size
+        expected_hdr.total_size = old_hdr.total_size
+        if ctypes.string_at(ctypes.addressof(expected_hdr), ctypes.sizeof(expected_hdr)) != old_data[:info_begin]:
+            return rebuild('idspace attributes changed')
+        if b''.join(ctypes.string_at(ctypes.addressof(col), ctypes.sizeof(col)) for col in columns.values()) != \
+                old_data[info_begin:data_begin]:
+            return rebuild('column layout changed')
+
+        old_rows = {}
+        try:
+            for i, attrib in enumerate(__iter_rows(previous, encoding, main_index)):
+                if 'ClassID' not in attrib or attrib['ClassID'] in old_rows:
+                    return rebuild('previous xml rows have no unique ClassID')
+                old_rows[attrib['ClassID']] = (i, attrib)
+        except Exception as e:
+            return rebuild('previous xml not parsed: {}'.format(e))
+        if len(old_rows) != old_hdr.row_count:
+            return rebuild('ies row count does not match previous xml')
+
+        old_view = memoryview(old_data)[data_begin:]
+        rows = []
+        changed = 0
+        for attrib in new_rows:
+            i, old_attrib = old_rows.get(attrib['ClassID'], (None, None))
+            if old_attrib == attrib:
+                rows.append(old_view[offsets[i]:offsets[i + 1]])
+            else:
+                rows.append(__encode_row(attrib, columns_number, columns_string, encoding, use_float))
+                changed += 1
+    data = __pack_ies(hdr, columns, rows)
 
-    os.utime(output, (-1, os.path.getmtime(input)))
+    written = write_file_atomic(output, data, skip_unchanged)
+    if written:
+        os.utime(output, (-1, os.path.getmtime(input)))
+
+    report = {'input': input, 'output': output, 'number_width': 4 if use_float else 8, 'written': written,
+              'patched': changed}
+    if main_index is not None:
+        report['original'] = main_index.file_name
+        report['original_parse_time'] = main_index.parse_time
+    return report
 
 
 def __validation_sizeof_ies():
@@ -498,25 +1584,143 @@ def __validation_sizeof_ies():
     if ctypes.sizeof(IESColumn) != 134:
         raise Exception('IESColumn size is invalid')
 
-def __generate_files(input, output, dictionary, encoding, order, float_val):
-    order = None
-    
-    if order:
-        order = os.path.abspath(order)
-        order_file = os.path.join(order, os.path.splitext(os.path.basename(input))[0] + '.xml')
-        try:
-            order = parse_order(order_file)
-        except FileNotFoundError:
-            logging.warning('Order not parsed, file {} missing'.format(order_file))
-    if input.endswith('.ies') and output.endswith('.xml'):
-        ies_to_xml(input, output, order, dictionary, encoding, float_val)
-    elif input.endswith('.xml') and output.endswith('.ies'):
-        xml_to_ies(input, output, order, dictionary, encoding, float_val)
+def __generate_files(input, output, dictionary, encoding, order, float_val, schema_cache, skip_unchanged, patch,
+                     reports):
+    try:
+        if order:
+            order_file = os.path.splitext(os.path.basename(input))[0] + '.xml'
+            try:
+                order = __order_cache(order).get(order_file)
+            except FileNotFoundError:
+                logging.warning('Order not parsed, file {} missing'.format(os.path.join(order, order_file)))
+                order = None
+        if input.endswith('.ies') and output.endswith('.xml'):
+            report = ies_to_xml(input, output, order, dictionary, encoding, float_val, skip_unchanged)
+        elif input.endswith('.xml') and output.endswith('.ies'):
+            previous = os.path.join(patch, os.path.basename(input)) if patch else None
+            if previous and os.path.isfile(previous):
+                report = patch_ies(previous, input, output, encoding, float_val, skip_unchanged)
+            else:
+                report = xml_to_ies(input, output, order, dictionary, encoding, float_val, schema_cache, skip_unchanged)
+        else:
+            raise Exception('Unknown file format combo. Must be ies+xml.')
+        if report is not None:
+            reports.append(report)
+    finally:
+        __release_original(input)
+
+
+# Piped input up to this size is kept in memory, beyond it spills to a temp file
+SPOOL_SIZE = 64 * 1024 * 1024
+
+
+def spool_input(stream, max_size=SPOOL_SIZE):
+    # IES reading seeks and xml is read twice, so copy a pipe into something seekable first
+    spool = tempfile.SpooledTemporaryFile(max_size=max_size)
+    for chunk in iter(lambda: stream.read(1024 * 1024), b''):
+        spool.write(chunk)
+    spool.seek(0)
+    return spool
+
+
+def __is_xml(fp):
+    head = fp.read(4)
+    fp.seek(0)
+    return head.lstrip(b' \t\r\n').startswith((b'<', codecs.BOM_UTF8, codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE))
+
+
+def __convert_stream(output, dictionary, encoding, float_val, skip_unchanged):
+    # Converts whatever arrives on stdin, ies or xml, to the other format on stdout or the output file
+    with spool_input(sys.stdin.buffer) as fp:
+        if output is None or output == '-':
+            # Keep the data stream clean, messages go to stderr from here on
+            output, sys.stdout = sys.stdout.buffer, sys.stderr
+        if __is_xml(fp):
+            report = xml_to_ies(fp, output, None, dictionary, encoding, float_val, skip_unchanged=skip_unchanged)
+        else:
+            report = ies_to_xml(fp, output, None, dictionary, encoding, float_val, skip_unchanged)
+    if report is None:
+        print('<stdin>: conversion failed')
+        return 1
+    report['input'] = '<stdin>'
+    __print_report([report], skip_unchanged)
+    return 0
+
+
+def __init_worker(parser):
+    global xml_parser
+    xml_parser = parser
+
+
+def __verify_files(inputs, encoding, float_val):
+    # Files are independent and the work is CPU bound, so spread them over processes rather than threads
+    inputs = sorted(input for input in inputs if input.endswith('.ies'))
+    with futures.ProcessPoolExecutor(initializer=__init_worker, initargs=(xml_parser,)) as pool:
+        reports = list(pool.map(verify_roundtrip, inputs, [encoding] * len(inputs), [float_val] * len(inputs),
+                                chunksize=4))
+    return 1 if __print_report(reports) else 0
+
+
+def __is_checked(input):
+    return input.endswith('.ies') or input.endswith('.xml')
+
+
+def __check_files(input, encoding, float_val, reports):
+    # A failing check must still report, a missing report would make the file count as passed
+    try:
+        if input.endswith('.ies'):
+            report = check_ies(input, float_val)
+        elif input.endswith('.xml'):
+            report = check_xml(input, encoding)
+        else:
+            return
+    except Exception as e:
+        report = {'input': input, 'output': None, 'number_width': None, 'errors': [str(e) or type(e).__name__]}
+    finally:
+        __release_original(input)
+    reports.append(report)
+
+
+def __print_report(reports, skip_unchanged=False):
+    failed = 0
+    for report in sorted(reports, key=lambda r: r['input']):
+        errors = report.get('errors')
+        if report['output'] is not None:
+            print('{} -> {} ({}{})'.format(report['input'], report['output'],
+                                           'float' if report['number_width'] == 4 else 'double',
+                                           '' if report.get('patched') is None else
+                                           ', {} row(s) patched'.format(report['patched'])))
+        elif errors:
+            failed += 1
+            for error in errors:
+                print('{}: {}'.format(report['input'], error))
+        else:
+            print('{}: OK'.format(report['input']))
+    if any(report['output'] is None for report in reports):
+        print('Checked {} file(s), {} failed'.format(len(reports), failed))
     else:
-        raise Exception('Unknown file format combo. Must be ies+xml.')
+        print('Converted {} file(s)'.format(len(reports)))
+        unchanged = sum(1 for report in reports if report.get('written') is False)
+        if skip_unchanged:
+            print('{} file(s) rewritten, {} unchanged'.format(len(reports) - unchanged, unchanged))
+    schema_cached = sum(1 for report in reports if report.get('schema_cached'))
+    if schema_cached:
+        print('Column layout of {} file(s) taken from schema cache'.format(schema_cached))
+
+    # Each main file was parsed once no matter how many locales were converted against it
+    originals = {}
+    for report in reports:
+        if report.get('original') is not None:
+            originals.setdefault(report['original'], []).append(report['original_parse_time'])
+    if originals:
+        saved = sum(parse_times[0] * (len(parse_times) - 1) for parse_times in originals.values())
+        print('Shared {} main file parse(s) across {} localized file(s), saved {:.3f}s'.format(
+            len(originals), sum(len(parse_times) for parse_times in originals.values()), saved))
+    return failed
 
 # noinspection PyUnresolvedReferences
 def main():
+    global xml_parser
     parser = argparse.ArgumentParser(description='ies to xml converter for Granado Espada by bit (rGE, 2015)')
     parser.add_argument('-o',
                         '--order',
@@ -530,45 +1734,112 @@ def main():
                         help='Use dictionary_local.xml to replace localized string placeholders.')
     parser.add_argument('-f',
                         '--float',
+                        action='store_const',
+                        const=True,
+                        help='Use single-precision floats for numbers array. '
+                             'Detected automatically for ies input if neither --float nor --double is given.')
+    parser.add_argument('--double',
+                        action='store_const',
+                        dest='float',
+                        const=False,
+                        help='Use double-precision floats for numbers array.')
+    parser.add_argument('--schema-cache',
+                        action='store_true',
+                        help='Keep inferred xml column layout in a .schema sidecar file next to each xml '
+                             'and reuse it while the file content is unchanged.')
+    parser.add_argument('--skip-unchanged',
+                        action='store_true',
+                        help='Leave output files untouched if their content would not change.')
+    parser.add_argument('-p',
+                        '--patch',
+                        help='Folder with the previous version of the input xml files. Existing output ies files '
+                             'are patched by re-encoding only rows that changed since then.')
+    parser.add_argument('--check',
                         action='store_true',
-                        help='Use single-precision floats for numbers array.')
+                        help='Only validate input files, no output is written.')
+    parser.add_argument('--verify-roundtrip',
+                        action='store_true',
+                        help='Convert every ies to xml and back in memory and compare with the original, '
+                             'reporting the first differing header field, column or row. No output is written.')
+    parser.add_argument('--locales',
+                        action='store_true',
+                        help='Input is a datatable folder, convert xml files in all of its locale subfolders '
+                             'sharing one parse of each main file.')
+    parser.add_argument('--parser',
+                        choices=('lxml', 'expat'),
+                        help='XML parser backend (default: expat).')
     parser.add_argument('input',
-                        help='Input folder (ies). '
+                        help='Input folder (ies), or - to convert a single ies or xml piped to stdin. '
                              'If this parameter is wildcard then output parameter will be ignored.')
     parser.add_argument('output',
-                        help='Output file (xml)',
+                        help='Output file, for - input only (default: stdout)',
                         nargs='?')
 
     args = parser.parse_args()
 
     __validation_sizeof_ies()
 
+    if args.parser == 'lxml' and not lxml_available():
+        raise Exception('lxml parser backend requested but lxml is not installed')
+    if args.parser:
+        xml_parser = args.parser
+
     input_folder = args.input
     encoding = args.encoding.upper()
 
+    if args.dict:
+        dictionary = parse_dict(args.dict)
+    else:
+        dictionary = None
+
+    if input_folder == '-':
+        if args.check or args.verify_roundtrip or args.locales or args.patch or args.order:
+            raise Exception('Input from stdin only supports plain conversion')
+        return __convert_stream(args.output, dictionary, encoding, args.float, args.skip_unchanged)
+
     args.input = []
     args.output = []
-    if not os.path.exists("folder_output"):
+    if not args.check and not args.verify_roundtrip and not os.path.exists("folder_output"):
         os.mkdir("folder_output")
 
-    for file_name in os.listdir(input_folder):
-        args.input.append(input_folder + '/' + file_name)
-        if file_name.endswith('.ies'):
-            args.output.append("folder_output" + '/' + file_name[:-3] + 'xml')
-        else:
-            args.output.append("folder_output" + '/' + file_name[:-3] + 'ies')
-        
-    if args.dict:
-        dictionary = parse_dict(args.dict)
+    if args.locales:
+        for locale in sorted(os.listdir(input_folder)):
+            locale_folder = input_folder + '/' + locale
+            if len(locale) != 3 or not os.path.isdir(locale_folder):
+                continue
+            if not args.check and not args.verify_roundtrip and not os.path.exists("folder_output" + '/' + locale):
+                os.mkdir("folder_output" + '/' + locale)
+            for file_name in sorted(os.listdir(locale_folder)):
+                if file_name.endswith('.xml'):
+                    args.input.append(locale_folder + '/' + file_name)
+                    args.output.append("folder_output" + '/' + locale + '/' + file_name[:-3] + 'ies')
     else:
-        dictionary = None
+        for file_name in os.listdir(input_folder):
+            if file_name.endswith('.xml.schema') or file_name == OrderCache.file_name:
+                # Sidecar caches written next to the inputs
+                continue
+            args.input.append(input_folder + '/' + file_name)
+            if file_name.endswith('.ies'):
+                args.output.append("folder_output" + '/' + file_name[:-3] + 'xml')
+            else:
+                args.output.append("folder_output" + '/' + file_name[:-3] + 'ies')
+
+    if args.verify_roundtrip:
+        return __verify_files(args.input, encoding, args.float)
 
     # Multithreading
     threads = []
+    reports = []
     try:
         for input, output in zip(args.input, args.output):
+            __queue_original(input)
+            if args.check:
+                threads.append(threading.Thread(target = __check_files, args = (input, encoding, args.float,
+                                                                                 reports)))
+                continue
             threads.append(threading.Thread(target =  __generate_files, args = (input, output, dictionary, encoding,
-                                                    args.order, args.float)))
+                                                    args.order, args.float, args.schema_cache,
+                                                    args.skip_unchanged, args.patch, reports)))
     except Exception as exp:
         print(exp)
         print("Error: Thread not initiated")
@@ -576,8 +1847,19 @@ def main():
         thread.start()
     for thread in threads:
         thread.join()
+    for cache in __order_caches.values():
+        cache.save()
+
+    status = 1 if __print_report(reports, args.skip_unchanged) else 0
+    if args.check:
+        checked = sum(1 for input in args.input if __is_checked(input))
+        if len(reports) < checked:
+            print('{} file(s) could not be checked'.format(checked - len(reports)))
+            status = 1
+    return status
 
 if __name__ == '__main__':
     start_time = datetime.now()
-    main()
+    status = main()
     print('Finished in', datetime.now() - start_time)
+    sys.exit(status)
@@ -1,17 +1,32 @@
 import copy
+import json
 import os
 import re
-from contextlib import suppress
+from bisect import bisect_left, bisect_right, insort
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, suppress
+from heapq import merge
+from itertools import islice
+from operator import itemgetter
 
 from lxml import etree
 
+# Start tag of a Class element, attribute values may hold '>'
+re_class_tag = re.compile(rb'<Class(?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|\'[^\']*\'))*\s*/?>')
+re_xml_encoding = re.compile(rb'^(?:\xef\xbb\xbf)?<\?xml[^>]*?encoding\s*=\s*["\']([A-Za-z0-9._-]+)["\']')
+
 
 class Class(object):
+    # One per row of a DataTable, so kept small. _merged is the base attributes overridden by the local ones,
+    # built on first read and dropped whenever the row is edited.
+    __slots__ = ('_dt', '_base', '_local', '_merged')
+
     def __init__(self, dt, base, local):
         super().__init__()
         self._dt = dt
         self._base = base
         self._local = local
+        self._merged = None
 
     def copy(self):
         base = None if self._base is None else copy.deepcopy(self._base)
@@ -22,74 +37,68 @@ class Class(object):
     def getparent(self):
         return self._dt
 
+    def _view(self):
+        merged = self._merged
+        if merged is None:
+            merged = {}
+            if self._base is not None:
+                merged.update(self._base.attrib)
+            if self._local is not None:
+                merged.update(self._local.attrib)
+            self._merged = merged
+        return merged
+
     def keys(self):
-        base_keys = []
-        local_keys = []
-        if self._base is not None:
-            base_keys = self._base.attrib.keys()
-        if self._local is not None:
-            local_keys = self._local.attrib.keys()
-        return list(set(base_keys + local_keys))
+        return list(self._view())
 
     def items(self):
         return list(self.__iter__())
 
     def get(self, key, default=None):
-        try:
-            self.__getitem__(key)
-        except KeyError:
-            return default
+        return self._view().get(key, default)
 
     def __len__(self):
-        return len(self.keys())
+        return len(self._view())
 
     def __iter__(self):
-        if self._base is None:
-            yield from self._local.attrib.items()
+        merged = self._view()
+        if self._base is None or self._local is None:
+            yield from merged.items()
             return
 
-        if self._local is None:
-            yield from self._base.attrib.items()
-            return
-
-        base = self._base.attrib
-        local = self._local.attrib
-        for k, v in base.items():
-            if k in local:
-                yield k, local[k]
-            else:
-                yield k, base[k]
+        # Base attributes in base order with local values, local only attributes come after them in the view
+        yield from islice(merged.items(), len(self._base.attrib))
 
     def __getitem__(self, k):
-        base = self._base.attrib if self._base is not None else {}
-        local = self._local.attrib if self._local is not None else {}
-        if k in local:
-            return local[k]
-        return base[k]
+        return self._view()[k]
+
+    def _attached(self):
+        # Parse the trees behind a snapshot before an edit, which can leave this row without its table
+        dt = self._dt
+        dt._materialize()
+        if self._dt is None:
+            raise Exception('Class {} was removed from datatable_{} since the table was loaded'.format(
+                self.get('ClassID'), dt._datatable_name))
 
     def __setitem__(self, k, v):
         if not isinstance(v, str):
             v = str(v)
 
+        if self._dt is not None:
+            self._attached()
         if self._dt is None:
             if self._local is not None:
                 self._local.attrib[k] = v
             elif self._base is not None:
                 self._base.attrib[k] = v
+            self._merged = None
             return
 
-        self._dt.is_dirty = True
+        self._dt._edited(self)
 
-        if k == 'ClassID':
+        if k in ('ClassID', 'ClassName'):
             old_k = self.__getitem__(k)
-            if old_k in self._dt._by_class_id:
-                del self._dt._by_class_id[old_k]
-            self._dt._by_class_id[v] = self
-        elif k == 'ClassName':
-            old_k = self.__getitem__(k)
-            if old_k in self._dt._by_class_name:
-                del self._dt._by_class_name[old_k]
-            self._dt._by_class_name[v] = self
+            self._dt._class_key_changed(self, k, old_k, v)
 
         if self._dt.xml_localized is not None:
             if self._local is None:
@@ -100,73 +109,506 @@ class Class(object):
                         if value is not None:
                             local_cls.attrib[field] = value
                 self._local = local_cls
-                self._dt._insert_cls(self._dt.xml_localized, local_cls)
+                self._dt._insert_localized(self, local_cls)
 
             base = self._base.attrib if self._base is not None else {}
             local = self._local.attrib
-            if k in base:
-                if base[k] == v:
-                    if k in local:
-                        del local[k]
-                    return
-            local[k] = v
+            old_v = local.get(k)
+            if k in base and base[k] == v:
+                if k in local:
+                    del local[k]
+            else:
+                local[k] = v
+            self._dt._attribute_changed(self._dt.xml_localized, self._local, k, old_v)
+            if k == 'ClassID':
+                self._dt._reindex_localized(self._local, old_k)
         else:
+            old_v = self._base.attrib.get(k)
             self._base.attrib[k] = v
+            self._dt._attribute_changed(self._dt.xml, self._base, k, old_v)
+        self._merged = None
+        if k == 'ClassID':
+            # Element stays where it is in the document, let the sorted index be rebuilt
+            self._dt._class_indexes.clear()
 
     def __contains__(self, o):
-        if self._base is not None and o in self._base.attrib:
-            return True
-        if self._local is not None and o in self._local.attrib:
-            return True
-        return False
+        return o in self._view()
 
     def __delitem__(self, k):
         if self._dt is not None:
-            self._dt.is_dirty = True
+            self._attached()
+            self._dt._edited(self)
+        self._merged = None
         if self._local is not None:
             local = self._local.attrib
             if k in local:
+                old_v = local[k]
                 del local[k]
+                if self._dt is not None:
+                    self._dt._attribute_changed(self._dt.xml_localized, self._local, k, old_v)
+                    if k == 'ClassID':
+                        self._dt._reindex_localized(self._local, old_v)
+                        self._dt._class_indexes.clear()
         else:
+            old_v = self._base.attrib[k]
             del self._base.attrib[k]
+            if self._dt is not None:
+                self._dt._attribute_changed(self._dt.xml, self._base, k, old_v)
+
+
+class SnapshotRow(object):
+    # Stand-in for a Class element loaded from a DataTable snapshot, index is its position among the Class
+    # elements of the tree so the real element can be swapped in once the tree is parsed
+    __slots__ = ('attrib', 'index')
+
+    def __init__(self, attrib, index):
+        self.attrib = attrib
+        self.index = index
+
+    def __deepcopy__(self, memo):
+        # Class.copy() result must be insertable into a tree
+        return etree.Element('Class', self.attrib)
+
+
+class Batch(object):
+    # State of a DataTable.batch() block: what Class edits would have maintained right away, applied at commit,
+    # and the old attribute values to put back on rollback
+    def __init__(self, dt):
+        self.dt = dt
+        self.is_dirty = dt.is_dirty
+        self.classes = set()
+        # (element, attribute) -> value before the block, None if it was not set
+        self.journal = {}
+        # (Class, 'ClassID' or 'ClassName') -> key before the block
+        self.keys = {}
+        # Class -> localized element created for it when it had none, not in the tree yet
+        self.created = {}
+        self.inserted = []
+        self.rows = {}
+        self.reindex_localized = False
+
+    def commit(self):
+        dt = self.dt
+        if self.created:
+            dest = dt.xml_localized
+            # Sorted so insert positions only move forward, the ClassID index is merged once
+            created = sorted(self.created.values(), key=lambda el: int(el.attrib['ClassID']))
+            index = dt._class_index(dest)
+            index.defer()
+            try:
+                for el in created:
+                    if dt._insert_cls(dest, el):
+                        self.inserted.append(el)
+            finally:
+                index.flush()
+        # Unmap every old key before mapping the new ones, so classes swapping keys keep both entries
+        for (cls, key), old_value in self.keys.items():
+            by_key = dt._by_class_id if key == 'ClassID' else dt._by_class_name
+            if by_key.get(old_value) is cls:
+                del by_key[old_value]
+        for cls, key in self.keys:
+            by_key = dt._by_class_id if key == 'ClassID' else dt._by_class_name
+            value = cls.get(key)
+            if value is not None:
+                by_key[value] = cls
+        if self.reindex_localized:
+            dt._index_localized()
+        if self.journal:
+            dt._attribute_indexes.clear()
+        for tree, rows in self.rows.items():
+            dt._dirty_rows.setdefault(tree, set()).update(rows)
+
+    def rollback(self):
+        dt = self.dt
+        for el in self.inserted:
+            el.getparent().remove(el)
+        for (el, name), old_value in self.journal.items():
+            if old_value is None:
+                el.attrib.pop(name, None)
+            else:
+                el.attrib[name] = old_value
+        for cls in self.classes:
+            if cls in self.created:
+                cls._local = None
+            cls._merged = None
+        if self.inserted:
+            dt._attribute_indexes.clear()
+            dt._index_localized()
+        dt._class_indexes.clear()
+        dt.is_dirty = self.is_dirty
+
+
+class ClassIndex(object):
+    # ClassIDs of one xml tree in ascending order next to their elements, so duplicate checks and insert positions
+    # are a bisect instead of a tree scan. Positions are only trusted while the document itself is in ClassID order.
+    def __init__(self, tree):
+        self.in_order = True
+        self.deferred = None
+        self.deferred_max = None
+        pairs = []
+        for el in tree.iter('Class'):
+            try:
+                class_id = int(el.attrib['ClassID'])
+            except (KeyError, ValueError):
+                continue
+            if pairs and class_id < pairs[-1][0]:
+                self.in_order = False
+            pairs.append((class_id, el))
+        self._set(pairs)
+
+    def _set(self, pairs):
+        pairs.sort(key=itemgetter(0))
+        self.ids = [class_id for class_id, _ in pairs]
+        self.elements = [el for _, el in pairs]
+
+    def __contains__(self, class_id):
+        i = bisect_left(self.ids, class_id)
+        if i < len(self.ids) and self.ids[i] == class_id:
+            return True
+        return self.deferred is not None and class_id in self.deferred
+
+    def max_id(self):
+        if self.deferred_max is not None and (not self.ids or self.deferred_max > self.ids[-1]):
+            return self.deferred_max
+        return self.ids[-1] if self.ids else None
+
+    def next_after(self, class_id):
+        # Element with the smallest ClassID above class_id, the first one in document order on ties
+        i = bisect_right(self.ids, class_id)
+        return self.elements[i] if i < len(self.elements) else None
+
+    def add(self, class_id, el):
+        if self.deferred is not None:
+            self.deferred[class_id] = el
+            if self.deferred_max is None or class_id > self.deferred_max:
+                self.deferred_max = class_id
+            return
+        i = bisect_right(self.ids, class_id)
+        self.ids.insert(i, class_id)
+        self.elements.insert(i, el)
+
+    def defer(self):
+        # Collect adds and merge them in one sort on flush(), for bulk inserts
+        self.deferred = {}
+
+    def flush(self):
+        deferred, self.deferred = self.deferred, None
+        self.deferred_max = None
+        if deferred:
+            self._set(list(zip(self.ids, self.elements)) + list(deferred.items()))
+
+
+class AttributeIndex(object):
+    # Hash indexes over the Class attributes of one xml tree, each attribute indexed the first time it is queried.
+    # Entries are (document position, element) so hits come back in document order, same as the xpath did.
+    def __init__(self, tree):
+        self.position = {el: i for i, el in enumerate(tree.iter('Class'))}
+        self.attributes = {}
+
+    def lookup(self, name, value):
+        values = self.attributes.get(name)
+        if values is None:
+            values = self.attributes[name] = {}
+            for el, i in self.position.items():
+                v = el.attrib.get(name)
+                if v is not None:
+                    values.setdefault(v, []).append((i, el))
+        return values.get(value, ())
+
+    def changed(self, el, name, old_value):
+        # Move el between value buckets after an attribute edit, False if el is unknown and the index is stale
+        values = self.attributes.get(name)
+        if values is None:
+            return True
+        i = self.position.get(el)
+        if i is None:
+            return False
+        if old_value is not None:
+            entries = values.get(old_value, [])
+            j = bisect_left(entries, (i,))
+            if j < len(entries) and entries[j][1] is el:
+                del entries[j]
+                if not entries:
+                    del values[old_value]
+        value = el.attrib.get(name)
+        if value is not None:
+            insort(values.setdefault(value, []), (i, el))
+        return True
 
 
 class DataTable(object):
-    def __init__(self, directory, datatable_name, locale=None):
+    snapshot_version = 2
+
+    def __init__(self, directory, datatable_name, locale=None, snapshot=False, trees=None):
+        # trees is what read_trees() returned for the table's paths, when it was parsed elsewhere
         self._directory = directory
         self._datatable_name = datatable_name
         self._source_locale = locale
         self.is_dirty = False
         self._by_class_id = {}
         self._by_class_name = {}
-        self.xml_localized = None
-        self.xml = None
+        self._localized_by_class_id = {}
+        self._class_indexes = {}
+        self._attribute_indexes = {}
+        # Row element (the base one when there is one) -> its Class, so queries hand out the same objects
+        self._classes = {}
+        self._xml_localized = None
+        self._xml = None
+        # Classes loaded from a snapshot while the trees are not parsed yet
+        self._snapshot_rows = None
+        # Edited elements per tree and trees whose structure changed, for save(delta=True)
+        self._dirty_rows = {}
+        self._rewrite = set()
+        # Stamps of the files as parsed, a delta save only patches files nobody else touched since
+        self._stamps = []
+        self._batch = None
         self.import_key = 'ClassID'
 
+        if snapshot and trees is None:
+            stamps = self._file_stamps()
+            if self._load_snapshot(stamps):
+                self._stamps = stamps
+                return
         try:
-            base_path = os.path.join(self._directory, 'datatable_{}.xml'.format(datatable_name))
+            if trees is None:
+                self._parse()
+            else:
+                self._stamps, self._xml, self._xml_localized = trees
+        finally:
+            self._index_localized()
+            self._index_table()
+        if snapshot:
+            self._save_snapshot(self._stamps)
+
+    # The trees are parsed on first use when the table came from a snapshot, i.e. for a save, a mutation or
+    # any query that needs xpath
+    @property
+    def xml(self):
+        self._materialize()
+        return self._xml
+
+    @xml.setter
+    def xml(self, xml):
+        self._xml = xml
+        self._drop_indexes()
+
+    @property
+    def xml_localized(self):
+        self._materialize()
+        return self._xml_localized
+
+    @xml_localized.setter
+    def xml_localized(self, xml_localized):
+        self._xml_localized = xml_localized
+        self._drop_indexes()
+
+    def _drop_indexes(self):
+        # After the trees were edited or replaced directly, which no index follows. Rebuilt on their next use.
+        self._attribute_indexes.clear()
+        self._class_indexes.clear()
+        self._localized_by_class_id = None
+        # Merged views of the Classes handed out are read from the trees again
+        for cls in self._classes.values():
+            cls._merged = None
+        for cls in self._snapshot_rows or ():
+            cls._merged = None
+
+    @staticmethod
+    def table_paths(directory, datatable_name, locale=None):
+        paths = [os.path.join(directory, 'datatable_{}.xml'.format(datatable_name))]
+        if locale is not None:
+            paths.append(os.path.join(directory, locale, 'datatable_{}.xml'.format(datatable_name)))
+        return paths
+
+    def _paths(self):
+        return self.table_paths(self._directory, self._datatable_name, self._source_locale)
+
+    @staticmethod
+    def read_trees(paths):
+        # File stamps, base root and localized root of a table, None for missing files. Touches nothing but the
+        # files, so tables can be read on other threads while lxml parses without the GIL.
+        stamps = DataTable._path_stamps(paths)
+        trees = []
+        for path in paths:
             try:
-                self.xml = etree.parse(base_path).getroot()
+                trees.append(etree.parse(path).getroot())
             except OSError:
-                self.xml = None
+                trees.append(None)
+        return stamps, trees[0], trees[1] if len(trees) > 1 else None
 
-            if locale is None:
-                return
+    def _parse(self):
+        self._stamps, self._xml, self._xml_localized = self.read_trees(self._paths())
+
+    def _snapshot_path(self):
+        locale = '' if self._source_locale is None else '.' + self._source_locale
+        return os.path.join(self._directory, '.datatable_{}{}.snapshot'.format(self._datatable_name, locale))
 
-            local_path = os.path.join(self._directory, self._source_locale, 'datatable_{}.xml'.format(datatable_name))
+    def _file_stamps(self):
+        return self._path_stamps(self._paths())
+
+    @staticmethod
+    def _path_stamps(paths):
+        # Path, size and mtime of the files behind the table, None for missing ones. Taken before parsing so a
+        # file changed in between makes the snapshot stale rather than wrong.
+        stamps = []
+        for path in paths:
             try:
-                self.xml_localized = etree.parse(local_path).getroot()
+                st = os.stat(path)
+                stamps.append((os.path.abspath(path), st.st_size, st.st_mtime_ns))
             except OSError:
-                return
-        finally:
-            self._index_table()
+                stamps.append(None)
+        return stamps
 
-    def _index_table(self):
+    def _load_snapshot(self, stamps):
+        # Plain json, loading a snapshot never runs code from the file
+        try:
+            with open(self._snapshot_path(), encoding='utf-8') as fp:
+                snapshot = json.load(fp)
+            if snapshot['version'] != self.snapshot_version or snapshot['stamps'] != self._json_stamps(stamps):
+                return False
+            schemas = [tuple(keys) for keys in snapshot['schemas']]
+
+            def rows(items):
+                return [SnapshotRow(dict(zip(schemas[row[0]], row[1:])), i) for i, row in enumerate(items)]
+
+            base = rows(snapshot['base'])
+            local = rows(snapshot['localized'])
+            classes = [Class(self, base[i] if i >= 0 else None, local[j] if j >= 0 else None)
+                       for i, j in snapshot['pairs']]
+        except Exception:
+            # Missing, unreadable, malformed or from another version, the xml is parsed instead
+            return False
+        self._snapshot_rows = classes
+        self._index_table(self._snapshot_rows)
+        return True
+
+    @staticmethod
+    def _json_stamps(stamps):
+        return [list(stamp) if stamp is not None else None for stamp in stamps]
+
+    def _save_snapshot(self, stamps):
+        if self._xml is None or stamps[0] is None:
+            return
+        base = list(self._xml.iter('Class'))
+        local = list(self._xml_localized.iter('Class')) if self._xml_localized is not None else []
+        if any(len(el) for el in base) or any(len(el) for el in local):
+            # Rows are attribute maps only, nested elements would be lost by Class.copy() before materializing
+            return
+        # Rows are [schema, *values], rows with the same attributes share one schema, i.e. list of keys
+        schemas = {}
+
+        def rows(elements):
+            result = []
+            for el in elements:
+                keys = tuple(el.attrib.keys())
+                result.append([schemas.setdefault(keys, len(schemas))] + el.attrib.values())
+            return result
+
+        # Base rows paired with their localized row, then the unmatched localized ones, as _join_localized does
+        positions = {el: i for i, el in enumerate(local)}
+        pairs = []
+        matched = set()
+        for i, el in enumerate(base):
+            j = -1
+            if self._xml_localized is not None:
+                localized = self._localized_index().get(el.attrib['ClassID'])
+                if localized is not None:
+                    j = positions[localized]
+                    matched.add(j)
+            pairs.append((i, j))
+        pairs.extend((-1, j) for j in range(len(local)) if j not in matched)
+
+        snapshot = {'version': self.snapshot_version, 'stamps': self._json_stamps(stamps), 'base': rows(base),
+                    'localized': rows(local), 'pairs': pairs}
+        snapshot['schemas'] = [list(keys) for keys in schemas]
+        path = self._snapshot_path()
+        with suppress(OSError):
+            with open(path + '.tmp', 'w', encoding='utf-8') as fp:
+                json.dump(snapshot, fp, ensure_ascii=False, separators=(',', ':'))
+            os.replace(path + '.tmp', path)
+
+    def _materialize(self):
+        # Parse the trees behind a snapshot and swap the real elements into the Classes already handed out
+        rows, self._snapshot_rows = self._snapshot_rows, None
+        if rows is None:
+            return
+        stamps = self._stamps
+        self._parse()
+        if self._stamps != stamps:
+            self._rebind(rows)
+            return
+        base = list(self._xml.iter('Class')) if self._xml is not None else []
+        local = list(self._xml_localized.iter('Class')) if self._xml_localized is not None else []
+        for cls in rows:
+            if cls._base is not None:
+                cls._base = base[cls._base.index]
+            if cls._local is not None:
+                cls._local = local[cls._local.index]
+            self._classes[cls._base if cls._base is not None else cls._local] = cls
+        self._index_localized()
+
+    def _rebind(self, rows):
+        # The files changed after the snapshot was taken, so positions no longer pair rows with elements. Every
+        # Class is built again from the fresh trees, reusing the objects already handed out by ClassID; those
+        # whose ClassID is gone are detached.
+        old = {}
+        for cls in rows:
+            old.setdefault(cls.get('ClassID'), cls)
+        self._classes = {}
+        self._by_class_id = {}
+        self._by_class_name = {}
+        self._drop_indexes()
+        for fresh in list(self.find_cls_xpath('.//Class')):
+            cls = old.pop(fresh.get('ClassID'), None)
+            if cls is not None:
+                cls._base, cls._local, cls._merged = fresh._base, fresh._local, None
+                self._classes[cls._base if cls._base is not None else cls._local] = cls
+        for cls in old.values():
+            cls._dt = None
+        self._index_localized()
+        self._index_table()
+
+    def _index_localized(self):
+        # ClassID -> the localized element find('.//Class[@ClassID=...]') would return, i.e. the first one
+        self._localized_by_class_id = {}
+        if self.xml_localized is not None:
+            for el in self.xml_localized.iter('Class'):
+                class_id = el.attrib.get('ClassID')
+                if class_id is not None:
+                    self._localized_by_class_id.setdefault(class_id, el)
+
+    def _localized_index(self):
+        if self._localized_by_class_id is None:
+            self._index_localized()
+        return self._localized_by_class_id
+
+    def _reindex_localized(self, el, old_class_id):
+        if self._batch is not None:
+            self._batch.reindex_localized = True
+            return
+        if self._localized_by_class_id is None:
+            return
+        if self._localized_by_class_id.get(old_class_id) is el:
+            del self._localized_by_class_id[old_class_id]
+        class_id = el.attrib.get('ClassID')
+        if class_id is not None:
+            self._localized_by_class_id.setdefault(class_id, el)
+
+    def _index_table(self, classes=None):
         has_class_name = True
-        for cls in self.find_cls_xpath('.//Class'):
-            self._by_class_id[cls['ClassID']] = cls
-            if 'ClassName' in cls:
-                self._by_class_name[cls['ClassName']] = cls
+        if classes is None:
+            classes = self.find_cls_xpath('.//Class')
+        for cls in classes:
+            # Keys read off the elements, building every merged view would cost more than the parse
+            local = cls._local.attrib if cls._local is not None else {}
+            base = cls._base.attrib if cls._base is not None else {}
+            class_id = local.get('ClassID', base.get('ClassID'))
+            if class_id is None:
+                raise KeyError('ClassID')
+            self._by_class_id[class_id] = cls
+            class_name = local.get('ClassName', base.get('ClassName'))
+            if class_name is not None:
+                self._by_class_name[class_name] = cls
             else:
                 has_class_name = False
         if has_class_name:
@@ -187,11 +629,18 @@ class DataTable(object):
     def insert_cls(self, cls):
         self.is_dirty = True
         cls._dt = self
+        cls._merged = None
         if self.xml_localized is not None:
             res = self._insert_cls(self.xml_localized, cls._local)
+            # Found again as a localized hit, unless its base element is a row of this table
+            in_base = cls._base is not None and cls._base.getroottree().getroot() is self._xml
+            key = cls._base if in_base else cls._local
         else:
             res = self._insert_cls(self.xml, cls._base)
+            key = cls._base
         if res:
+            # Queries hand out this object from now on, keyed the way _row() looks it up
+            self._classes[key] = cls
             self._by_class_id[cls['ClassID']] = cls
             if 'ClassName' in cls:
                 self._by_class_name[cls['ClassName']] = cls
@@ -199,52 +648,227 @@ class DataTable(object):
             cls._dt = None
         return res
 
+    def insert_cls_bulk(self, classes):
+        # Inserts in ClassID order so each insert position moves forward, index is merged once at the end
+        dest = self.xml_localized if self.xml_localized is not None else self.xml
+        index = self._class_index(dest)
+        index.defer()
+        try:
+            return sum(1 for cls in sorted(classes, key=lambda cls: int(cls['ClassID'])) if self.insert_cls(cls))
+        finally:
+            index.flush()
+
+    def _class_index(self, dest):
+        index = self._class_indexes.get(dest)
+        if index is None:
+            index = self._class_indexes[dest] = ClassIndex(dest)
+        return index
+
     def _insert_cls(self, dest, cls):
+        # Document positions shift, attribute indexes of this tree are rebuilt on their next query
+        self._attribute_indexes.pop(dest, None)
+        index = self._class_index(dest)
         class_id = int(cls.attrib['ClassID'])
         if class_id == -1 or dest.attrib['id'] in ('ChangeItemRatioDelect', 'ChangeItemRatio'):
-            cls.attrib['ClassID'] = str(int(next(dest.iterchildren(reversed=True)).attrib['ClassID']) + 1)
-            dest.append(cls)
+            class_id = int(next(dest.iterchildren(reversed=True)).attrib['ClassID']) + 1
+            cls.attrib['ClassID'] = str(class_id)
+            next_cls = None
         else:
-            parent_cls = dest.find('.//Class[@ClassID="{}"]'.format(class_id))
-            if parent_cls is not None:
+            if class_id in index:
                 # This class already exists
                 return False
-            next_cls = dest.xpath('.//Class[@ClassID>$class_id]', class_id=class_id)
-            if len(next_cls) > 0:
-                next_cls = next_cls[0]
-                parent = next_cls.getparent()
-                parent.insert(parent.index(next_cls), cls)
+            if index.in_order:
+                next_cls = index.next_after(class_id)
             else:
-                dest.append(cls)
+                next_cls = dest.xpath('.//Class[@ClassID>$class_id]', class_id=class_id)
+                next_cls = next_cls[0] if len(next_cls) > 0 else None
+        self._rewrite.add(dest)
+        if next_cls is not None:
+            next_cls.addprevious(cls)
+        else:
+            max_id = index.max_id()
+            if max_id is not None and class_id < max_id:
+                index.in_order = False
+            dest.append(cls)
+        index.add(class_id, cls)
+        if dest is self.xml_localized and self._localized_by_class_id is not None:
+            self._localized_by_class_id.setdefault(cls.attrib['ClassID'], cls)
         return True
 
-    def save(self):
-        if self.xml is not None:
-            # Save main xml file
-            xml_path = os.path.join(self._directory, 'datatable_{}.xml'.format(self._datatable_name))
-            with open(xml_path, 'w+b') as fp:
-                self._indent_tree(self.xml)
-                etree.ElementTree(self.xml).write(fp, encoding='utf-8', xml_declaration=True, pretty_print=True)
+    @contextmanager
+    def batch(self):
+        # Class edits inside the block skip the per edit upkeep: ClassID/ClassName maps, localized element inserts
+        # and attribute indexes are brought up to date once when the block exits, and every edit is undone if it
+        # raises. Lookups and queries inside the block see the table as it was before it.
+        if self._batch is not None:
+            # Nested blocks are part of the outer one
+            yield self
+            return
+        batch = self._batch = Batch(self)
+        try:
+            yield self
+            self._batch = None
+            batch.commit()
+        except BaseException:
+            self._batch = None
+            batch.rollback()
+            raise
+
+    def _edited(self, cls):
+        self.is_dirty = True
+        if self._batch is not None:
+            self._batch.classes.add(cls)
 
-        if self.xml_localized is not None:
-            # Save localized xml file
-            xml_path = os.path.join(self._directory, self._source_locale, 'datatable_{}.xml'.format(self._datatable_name))
-            with open(xml_path, 'w+b') as fp:
-                self._indent_tree(self.xml_localized)
-                etree.ElementTree(self.xml_localized).write(fp, encoding='utf-8', xml_declaration=True, pretty_print=True)
+    def _class_key_changed(self, cls, key, old_value, value):
+        if self._batch is not None:
+            self._batch.keys.setdefault((cls, key), old_value)
+            return
+        by_key = self._by_class_id if key == 'ClassID' else self._by_class_name
+        if old_value in by_key:
+            del by_key[old_value]
+        by_key[value] = cls
+
+    def _insert_localized(self, cls, el):
+        if self._batch is not None:
+            self._batch.created[cls] = el
+        else:
+            self._insert_cls(self.xml_localized, el)
+
+    def mark_dirty(self):
+        # For edits made straight on the trees, which are not tracked: the next save rewrites both files and the
+        # indexes are rebuilt from the edited trees
+        self.is_dirty = True
+        self._rewrite.update(tree for tree in (self.xml, self.xml_localized) if tree is not None)
+        self._drop_indexes()
+
+    def save(self, delta=False):
+        # delta=True writes only the files with tracked edits and patches just the edited <Class> tags into them,
+        # a file is written whole when classes were inserted into it or the patch can not be trusted
+        paths = self._paths()
+        if delta:
+            trees = [self._xml, self._xml_localized]
+        else:
+            trees = [self.xml, self.xml_localized]
+        for i, (path, tree) in enumerate(zip(paths, trees)):
+            if tree is None:
+                continue
+            if not delta or tree in self._rewrite:
+                self._write_file(path, tree)
+            elif tree in self._dirty_rows:
+                if not self._patch_file(i, tree, self._dirty_rows[tree]):
+                    self._write_file(path, tree)
+            else:
+                continue
+            self._dirty_rows.pop(tree, None)
+            self._rewrite.discard(tree)
+            self._stamps[i] = self._file_stamps()[i]
+
+    def _write_file(self, path, tree):
+        with open(path, 'w+b') as fp:
+            self._indent_tree(tree)
+            etree.ElementTree(tree).write(fp, encoding='utf-8', xml_declaration=True, pretty_print=True)
+
+    def _patch_file(self, i, tree, rows):
+        # The k-th Class start tag of the file is the k-th Class element of the tree as long as the file is the one
+        # parsed or saved last and no class was inserted since. False when that does not hold and the file needs a
+        # full write.
+        path = self._paths()[i]
+        if self._stamps[i] is None or self._file_stamps()[i] != self._stamps[i]:
+            return False
+        with open(path, 'rb') as fp:
+            data = fp.read()
+        m = re_xml_encoding.match(data)
+        encoding = m.group(1).decode('ascii') if m is not None else 'UTF-8'
+        try:
+            if '<Class'.encode(encoding) != b'<Class':
+                # Tags can only be found in ascii compatible encodings
+                return False
+        except LookupError:
+            return False
+        tags = [m.span() for m in re_class_tag.finditer(data)]
+        position = {el: i for i, el in enumerate(tree.iter('Class'))}
+        if len(tags) != len(position):
+            return False
+        patches = []
+        for el in rows:
+            i = position.get(el)
+            if i is None or len(el) or not data.endswith(b'/>', 0, tags[i][1]):
+                return False
+            patches.append(tags[i] + (etree.tostring(el, encoding=encoding, xml_declaration=False, with_tail=False),))
+        patches.sort()
+        output = bytearray()
+        last = 0
+        for start, end, tag in patches:
+            output += data[last:start]
+            output += tag
+            last = end
+        output += data[last:]
+        with open(path + '.tmp', 'wb') as fp:
+            fp.write(output)
+        os.replace(path + '.tmp', path)
+        return True
+
+    def _attribute_changed(self, tree, el, name, old_value):
+        if self._batch is not None:
+            self._batch.journal.setdefault((el, name), old_value)
+            self._batch.rows.setdefault(tree, set()).add(el)
+            return
+        self._dirty_rows.setdefault(tree, set()).add(el)
+        index = self._attribute_indexes.get(tree)
+        if index is not None and not index.changed(el, name, old_value):
+            del self._attribute_indexes[tree]
+
+    def _select(self, tree, condition, kwargs):
+        # Class elements of tree whose own attributes match, in document order
+        index = self._attribute_indexes.get(tree)
+        if index is None:
+            index = self._attribute_indexes[tree] = AttributeIndex(tree)
+        query = [(k, '{}'.format(v)) for k, v in kwargs.items()]
+        hits = [index.lookup(k, v) for k, v in query]
+        if condition == 'and':
+            return [el for _, el in min(hits, key=len) if all(el.attrib.get(k) == v for k, v in query)]
+        result = []
+        last = None
+        for i, el in merge(*hits, key=itemgetter(0)):
+            if i != last:
+                result.append(el)
+                last = i
+        return result
 
     def find_cls_xpath(self, xpath):
-        all_localized = self.xml_localized.xpath(xpath) if self.xml_localized is not None else []
-        for el in self.xml.xpath(xpath):
-            localized = None
-            if self.xml_localized is not None:
-                localized = self.xml_localized.find(f'.//Class[@ClassID="{el.attrib["ClassID"]}"]')
-                if localized is not None:
-                    with suppress(ValueError):
-                        all_localized.remove(localized)
-            yield Class(self, el, localized)
+        all_localized = self.xml_localized.xpath(xpath) if self.xml_localized is not None else None
+        yield from self._join_localized(self.xml.xpath(xpath), all_localized)
+
+    def _join_localized(self, elements, all_localized):
+        # Pair base hits with their localized element, then the localized hits that had no base hit
+        if all_localized is None:
+            for el in elements:
+                yield self._row(el, None)
+            return
+
+        matched = set()
+        for el in elements:
+            localized = self._localized_index().get(el.attrib['ClassID'])
+            if localized is not None:
+                matched.add(localized)
+            yield self._row(el, localized)
         for localized in all_localized:
-            yield Class(self, None, localized)
+            if localized not in matched:
+                yield self._row(None, localized)
+
+    def _row(self, base, local):
+        # Cached Class of the row, repaired if the localized element it pairs with changed since
+        key = base if base is not None else local
+        cls = self._classes.get(key)
+        if cls is None:
+            cls = self._classes[key] = Class(self, base, local)
+        elif cls._local is not local:
+            if local is None and self._batch is not None and self._batch.created.get(cls) is cls._local:
+                # Created inside the running batch() block, it joins the tree when the block exits
+                return cls
+            cls._local = local
+            cls._merged = None
+        return cls
 
     def get_cls_xpath(self, xpath):
         try:
@@ -253,11 +877,20 @@ class DataTable(object):
             return None
 
     def find_cls(self, *, condition='or', **kwargs):
-        if len(kwargs):
+        if not len(kwargs) and self._snapshot_rows is not None:
+            # Plain iteration of a snapshot table does not need the trees
+            yield from list(self._snapshot_rows)
+        elif not len(kwargs):
+            yield from self.find_cls_xpath('.//Class')
+        elif condition in ('or', 'and'):
+            # Equality queries go through the attribute indexes
+            all_localized = None
+            if self.xml_localized is not None:
+                all_localized = self._select(self.xml_localized, condition, kwargs)
+            yield from self._join_localized(self._select(self.xml, condition, kwargs), all_localized)
+        else:
             yield from self.find_cls_xpath('.//Class[' + (' {} '.format(condition)).join(
                     ['@{}=\'{}\''.format(k, v) for k, v in kwargs.items()]) + ']')
-        else:
-            yield from self.find_cls_xpath('.//Class')
 
     def get_cls(self, *, condition='or', **kwargs):
         try:
@@ -281,11 +914,18 @@ class LazyDataTables(object):
                        'item_neck', 'item_ring', 'item_shoulder', 'item_weapon', 'item_etc', 'item_recipe',
                        'item_assist')
     monster_datatables = ('monster_1', 'monster_2', 'monster_3', 'monster_4')
+    groups = {'item': item_datatables, 'monster': monster_datatables}
+    index_cache_name = '.lazy_datatables_index.json'
 
-    def __init__(self, directory, source_locale=None):
+    def __init__(self, directory, source_locale=None, prefetch_workers=0, snapshot=False):
         self._directory = directory
         self.data_tables = {}
         self._source_locale = source_locale
+        self._group_indexes = {}
+        # Threads used to load the members of a group together, 0 loads them one by one as they are iterated
+        self.prefetch_workers = prefetch_workers
+        # Load tables from binary snapshots next to the xml files when they are up to date, see DataTable
+        self.snapshot = snapshot
 
     @staticmethod
     def filename_to_datatable(filename):
@@ -304,10 +944,11 @@ class LazyDataTables(object):
         try:
             return self.data_tables[datatable_name]
         except KeyError:
-            datatable = self.data_tables[datatable_name] = DataTable(self._directory, datatable_name, self._source_locale)
+            datatable = self.data_tables[datatable_name] = DataTable(self._directory, datatable_name, self._source_locale,
+                                                                     self.snapshot)
             return datatable
 
-    def get_datatables(self, datatable_name):
+    def _datatable_names(self, datatable_name):
         if isinstance(datatable_name, str):
             datatable_names = [datatable_name]
         else:
@@ -318,6 +959,34 @@ class LazyDataTables(object):
 
         if 'monster' in datatable_names:
             datatable_names.extend(self.monster_datatables)
+        return datatable_names
+
+    def prefetch(self, datatable_name, workers=None):
+        # Parse tables on a thread pool, lxml releases the GIL while parsing. Building the Classes and indexes
+        # of a table holds the GIL, so that is done here one table at a time while the pool parses the next
+        # ones. Tables are stored in the requested order so data_tables ends up the same as with sequential
+        # loading.
+        names = [name for name in dict.fromkeys(self._datatable_names(datatable_name))
+                 if name not in self.data_tables]
+        if not names:
+            return
+        workers = workers or self.prefetch_workers or min(len(names), os.cpu_count() or 1)
+        if workers < 2 or self.snapshot:
+            # Nothing runs alongside a single worker, and snapshots are loaded without parsing
+            for name in names:
+                self._get_datatable(name)
+            return
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(DataTable.read_trees,
+                                   DataTable.table_paths(self._directory, name, self._source_locale))
+                       for name in names]
+            for name, future in zip(names, futures):
+                self.data_tables[name] = DataTable(self._directory, name, self._source_locale, trees=future.result())
+
+    def get_datatables(self, datatable_name):
+        datatable_names = self._datatable_names(datatable_name)
+        if self.prefetch_workers and len(datatable_names) > 1:
+            self.prefetch(datatable_names)
 
         for datatable_name in datatable_names:
             dt = self._get_datatable(datatable_name)
@@ -347,10 +1016,10 @@ class LazyDataTables(object):
                 return cls
         return None
 
-    def save(self):
+    def save(self, delta=False):
         for dt in self.data_tables.values():
             if dt.is_dirty:
-                dt.save()
+                dt.save(delta)
 
     def insert_cls(self, datatable, cls):
         dest = next(self.get_datatables(datatable))
@@ -363,15 +1032,90 @@ class LazyDataTables(object):
 
     def mark_dirty(self, owner_datatable):
         for dt in self.get_datatables(owner_datatable):
-            dt.is_dirty = True
+            dt.mark_dirty()
+
+    def _table_stamps(self, names):
+        # mtime and size of every file behind the tables, None for missing ones
+        stamps = {}
+        for name in names:
+            paths = [os.path.join(self._directory, 'datatable_{}.xml'.format(name))]
+            if self._source_locale is not None:
+                paths.append(os.path.join(self._directory, self._source_locale, 'datatable_{}.xml'.format(name)))
+            stamps[name] = []
+            for path in paths:
+                try:
+                    st = os.stat(path)
+                    stamps[name].append([st.st_mtime_ns, st.st_size])
+                except OSError:
+                    stamps[name].append(None)
+        return stamps
+
+    def _group_index(self, group):
+        # ClassID/ClassName -> name of the first table of the group that has it, in get_datatables order.
+        # Built from the loaded tables once and kept in a sidecar next to the tables, so a later run only
+        # loads the table a lookup resolves to.
+        try:
+            return self._group_indexes[group]
+        except KeyError:
+            pass
+        names = [group] + list(self.groups[group])
+        key = '{}/{}'.format(group, self._source_locale)
+        stamps = self._table_stamps(names)
+        cache_path = os.path.join(self._directory, self.index_cache_name)
+        try:
+            with open(cache_path, encoding='utf-8') as fp:
+                cache = json.load(fp)
+        except (OSError, ValueError):
+            cache = {}
+        index = cache.get(key)
+        if index is None or index['stamps'] != stamps:
+            index = {'stamps': stamps, 'ClassID': {}, 'ClassName': {}}
+            self.prefetch(names)
+            has_dirty = False
+            for name in names:
+                dt = self._get_datatable(name)
+                if dt.is_dirty:
+                    # Unsaved edits are not what the stamps describe, and _group_lookup checks dirty tables anyway
+                    has_dirty = True
+                    continue
+                for class_id in dt._by_class_id:
+                    index['ClassID'].setdefault(class_id, name)
+                for class_name in dt._by_class_name:
+                    index['ClassName'].setdefault(class_name, name)
+            if not has_dirty:
+                # Only an index of the files as they are on disk is kept for later runs
+                cache[key] = index
+                with suppress(OSError):
+                    with open(cache_path, 'w', encoding='utf-8') as fp:
+                        json.dump(cache, fp)
+        self._group_indexes[group] = index
+        return index
+
+    def _group_lookup(self, group, key, value):
+        # Unloaded tables are as the index saw them on disk, only the indexed owner and tables changed since
+        # loading need a look
+        owner = self._group_index(group)[key].get(value)
+        for name in [group] + list(self.groups[group]):
+            dt = self.data_tables.get(name)
+            if name != owner and (dt is None or not dt.is_dirty):
+                continue
+            dt = self._get_datatable(name)
+            cls = dt.get_by_class_id(value) if key == 'ClassID' else dt.get_by_class_name(value)
+            if cls is not None:
+                return cls
+        return None
 
     def get_by_class_id(self, datatable, class_id):
+        if isinstance(datatable, str) and datatable in self.groups:
+            return self._group_lookup(datatable, 'ClassID', class_id)
         for dt in self.get_datatables(datatable):
             cls = dt.get_by_class_id(class_id)
             if cls is not None:
                 return cls
 
     def get_by_class_name(self, datatable, class_name):
+        if isinstance(datatable, str) and datatable in self.groups:
+            return self._group_lookup(datatable, 'ClassName', class_name)
         for dt in self.get_datatables(datatable):
             cls = dt.get_by_class_name(class_name)
             if cls is not None:
@@ -379,11 +1123,12 @@ class LazyDataTables(object):
 
     def create_cls(self, table, class_id):
         dt = self._get_datatable(table)
+        # Detached, insert_cls puts it at its ClassID position
         if dt.xml_localized is not None:
-            local_el = etree.SubElement(dt.xml_localized, 'Class', {'ClassID': class_id})
+            local_el = etree.Element('Class', {'ClassID': class_id})
             el = None
         else:
-            el = etree.SubElement(dt.xml, 'Class', {'ClassID': class_id})
+            el = etree.Element('Class', {'ClassID': class_id})
             local_el = None
         cls = Class(dt, el, local_el)
         self.insert_cls(table, cls)
@@ -0,0 +1,263 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import ies2
+
+ROWS = [
+    '\t<Class ClassID="1" ClassName="A" Price="10" Name="Ay"/>\n',
+    '\t<Class ClassID="2" ClassName="B" Price="20" Name="Bee"/>\n',
+    '\t<Class ClassID="3" ClassName="C" Price="30" Name="Cee"/>\n',
+    '\t<Class ClassID="4" ClassName="D" Price="40" Name="Dee"/>\n',
+]
+
+
+def shop(rows, schema=''):
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n<idspace id="shop">\n' + schema + ''.join(rows) +
+            '</idspace>\n').encode('utf-8')
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as fp:
+        fp.write(data)
+
+
+def read(path):
+    with open(path, 'rb') as fp:
+        return fp.read()
+
+
+class IesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.parser = ies2.xml_parser
+
+    def tearDown(self):
+        ies2.xml_parser = self.parser
+        shutil.rmtree(self.directory)
+
+    def path(self, *names):
+        return os.path.join(self.directory, *names)
+
+    def convert(self, input, output, use_float=False, **kwargs):
+        return ies2.xml_to_ies(input, output, None, None, None, use_float, **kwargs)
+
+
+class NumberWidthTest(IesTestCase):
+
+    def test_detect(self):
+        input = self.path('datatable_shop.xml')
+        write(input, shop(ROWS))
+        for use_float, width in ((True, 4), (False, 8)):
+            output = self.path('{}.ies'.format(width))
+            self.convert(input, output, use_float)
+            report = ies2.ies_to_xml(output, self.path('{}.xml'.format(width)), None, None, None)
+            self.assertEqual(report['number_width'], width)
+            self.assertEqual(self.convert(self.path('{}.xml'.format(width)), self.path('rebuilt.ies'),
+                                          width == 4)['number_width'], width)
+            self.assertEqual(read(self.path('rebuilt.ies')), read(output))
+
+
+class CheckTest(IesTestCase):
+
+    def test_check_ies(self):
+        input = self.path('datatable_shop.xml')
+        write(input, shop(ROWS))
+        self.convert(input, self.path('shop.ies'), True)
+        report = ies2.check_ies(self.path('shop.ies'))
+        self.assertEqual(report['errors'], [])
+        self.assertEqual(report['number_width'], 4)
+        write(self.path('short.ies'), read(self.path('shop.ies'))[:-1])
+        self.assertEqual(ies2.check_ies(self.path('short.ies'))['errors'], ['total_size does not match file size'])
+
+    def test_check_xml(self):
+        input = self.path('datatable_shop.xml')
+        write(input, shop(ROWS))
+        self.assertEqual(ies2.check_xml(input, 'UTF-8')['errors'], [])
+        write(input, shop([ROWS[0].replace('ClassID="1"', 'ClassID="x"')]))
+        self.assertEqual(ies2.check_xml(input, 'UTF-8')['errors'], ['Invalid ClassID x'])
+        write(input, shop([ROWS[0], ROWS[1].replace('Price="20"', 'Price="free"')]))
+        self.assertEqual(ies2.check_xml(input, 'UTF-8')['errors'],
+                         ['Column Price type mismatch in ClassID=2. Add ClassSchema entry.'])
+        write(input, shop(ROWS)[:-10])
+        self.assertEqual(ies2.check_xml(input, 'UTF-8')['errors'], ['Could not parse xml'])
+
+
+class StreamTest(IesTestCase):
+
+    def run_stdin(self, data, *args):
+        return subprocess.run([sys.executable, ies2.__file__, '-e', 'UTF-8'] + list(args or ['-']), input=data,
+                              cwd=self.directory, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True).stdout
+
+    def test_stdin_to_stdout(self):
+        input = self.path('datatable_shop.xml')
+        write(input, shop(ROWS))
+        self.convert(input, self.path('shop.ies'))
+        self.assertEqual(self.run_stdin(shop(ROWS)), read(self.path('shop.ies')))
+        xml = self.run_stdin(read(self.path('shop.ies')))
+        write(self.path('shop.xml'), xml)
+        self.convert(self.path('shop.xml'), self.path('rebuilt.ies'))
+        self.assertEqual(read(self.path('rebuilt.ies')), read(self.path('shop.ies')))
+
+    def test_stdin_to_file(self):
+        self.assertIn(b'<stdin> -> shop.ies (float)', self.run_stdin(shop(ROWS), '--float', '-', 'shop.ies'))
+        input = self.path('datatable_shop.xml')
+        write(input, shop(ROWS))
+        self.convert(input, self.path('file.ies'), True)
+        self.assertEqual(read(self.path('shop.ies')), read(self.path('file.ies')))
+        self.assertFalse(os.path.exists(self.path('folder_output')))
+
+
+class VerifyRoundtripTest(IesTestCase):
+
+    def setUp(self):
+        super().setUp()
+        input = self.path('datatable_shop.xml')
+        write(input, shop(ROWS))
+        os.mkdir(self.path('ies'))
+        self.convert(input, self.path('ies', 'good.ies'))
+
+    def write_bad(self):
+        # The is_scr flag of the last string column is the last byte, a rebuild derives it from the value
+        data = bytearray(read(self.path('ies', 'good.ies')))
+        data[-1] = 1
+        write(self.path('ies', 'bad.ies'), bytes(data))
+
+    def test_verify(self):
+        report = ies2.verify_roundtrip(self.path('ies', 'good.ies'), 'UTF-8')
+        self.assertEqual(report['errors'], [])
+        self.assertEqual(report['number_width'], 8)
+        self.write_bad()
+        self.assertEqual(ies2.verify_roundtrip(self.path('ies', 'bad.ies'), 'UTF-8')['errors'],
+                         ["Row 3 (ClassID 4) column is_scr differs: b'\\x00\\x01' != b'\\x00\\x00'"])
+
+    def test_verify_files(self):
+        command = [sys.executable, ies2.__file__, '-e', 'UTF-8', '--verify-roundtrip', 'ies']
+        self.assertEqual(subprocess.run(command, cwd=self.directory, stdout=subprocess.DEVNULL).returncode, 0)
+        self.write_bad()
+        self.assertEqual(subprocess.run(command, cwd=self.directory, stdout=subprocess.DEVNULL).returncode, 1)
+        self.assertFalse(os.path.exists(self.path('folder_output')))
+
+
+class OriginalCacheTest(IesTestCase):
+
+    def test_released_after_last_locale(self):
+        # Module private helpers, looked up by name as the class body would mangle them
+        queue_original = getattr(ies2, '__queue_original')
+        generate_files = getattr(ies2, '__generate_files')
+        cache = getattr(ies2, '__original_cache')
+        main = os.path.abspath(self.path('datatable_shop.xml'))
+        write(main, shop(ROWS))
+        inputs = [self.path(locale, 'datatable_shop.xml') for locale in ('eng', 'kor')]
+        for input in inputs:
+            write(input, shop([ROWS[1].replace('Bee', 'Bea')]))
+            queue_original(input)
+        reports = []
+        generate_files(inputs[0], self.path('eng.ies'), None, 'UTF-8', None, False, False, False, None, reports)
+        self.assertIn(main, cache)
+        index = cache[main][2][0]
+        generate_files(inputs[1], self.path('kor.ies'), None, 'UTF-8', None, False, False, False, None, reports)
+        self.assertNotIn(main, cache)
+        self.assertEqual([report['original'] for report in reports], [main, main])
+        self.assertEqual(reports[1]['original_parse_time'], index.parse_time)
+        # Nothing queued, nothing kept
+        self.convert(inputs[0], self.path('eng.ies'))
+        self.assertNotIn(main, cache)
+
+
+class SchemaCacheTest(IesTestCase):
+
+    @unittest.skipUnless(ies2.lxml_available(), 'lxml is not installed')
+    def test_cache_per_backend(self):
+        # lxml decodes EUC-KR itself, expat passes the bytes through, the cached layout of one must not reach the other
+        input = self.path('datatable_shop.xml')
+        write(input, '<?xml version="1.0" encoding="EUC-KR"?>\n<idspace id="shop">\n'
+                     '\t<Class ClassID="1" ClassName="A" Name="가나"/>\n</idspace>\n'.encode('euc-kr'))
+        self.convert(input, self.path('plain.ies'))
+        for parser in ('lxml', 'expat'):
+            ies2.xml_parser = parser
+            report = self.convert(input, self.path(parser + '.ies'), schema_cache=True)
+            self.assertFalse(report['schema_cached'])
+            self.assertEqual(read(self.path(parser + '.ies')), read(self.path('plain.ies')))
+        report = self.convert(input, self.path('cached.ies'), schema_cache=True)
+        self.assertTrue(report['schema_cached'])
+        self.assertEqual(read(self.path('cached.ies')), read(self.path('plain.ies')))
+
+
+class PatchTest(IesTestCase):
+
+    def patch(self, previous, input, use_float=False, directory=''):
+        # Patched output must come out byte for byte as a rebuild from the new xml
+        previous_path = self.path('previous', directory, 'datatable_shop.xml')
+        input_path = self.path('input', directory, 'datatable_shop.xml')
+        write(previous_path, previous)
+        write(input_path, input)
+        output = self.path('patched.ies')
+        self.convert(previous_path, output, use_float)
+        report = ies2.patch_ies(previous_path, input_path, output, None)
+        self.convert(input_path, self.path('rebuilt.ies'), use_float)
+        self.assertEqual(read(output), read(self.path('rebuilt.ies')))
+        return report
+
+    def test_edit(self):
+        rows = list(ROWS)
+        rows[1] = rows[1].replace('Price="20"', 'Price="25"').replace('Bee', 'Bea')
+        self.assertEqual(self.patch(shop(ROWS), shop(rows))['patched'], 1)
+
+    def test_append(self):
+        rows = ROWS + ['\t<Class ClassID="9" ClassName="I" Price="90" Name="Eye"/>\n']
+        self.assertEqual(self.patch(shop(ROWS), shop(rows))['patched'], 1)
+
+    def test_insert(self):
+        rows = list(ROWS)
+        rows.insert(2, '\t<Class ClassID="9" ClassName="I" Price="90" Name="Eye"/>\n')
+        self.assertEqual(self.patch(shop(ROWS), shop(rows))['patched'], 1)
+
+    def test_delete(self):
+        self.assertEqual(self.patch(shop(ROWS), shop(ROWS[:1] + ROWS[2:]))['patched'], 0)
+
+    def test_swap(self):
+        rows = [ROWS[0], ROWS[2], ROWS[1], ROWS[3]]
+        self.assertIsNotNone(self.patch(shop(ROWS), shop(rows))['patched'])
+
+    def test_unchanged(self):
+        self.assertEqual(self.patch(shop(ROWS), shop(ROWS))['patched'], 0)
+
+    def test_float(self):
+        rows = list(ROWS)
+        rows[3] = rows[3].replace('Price="40"', 'Price="40.5"')
+        report = self.patch(shop(ROWS), shop(rows), use_float=True)
+        self.assertEqual(report['patched'], 1)
+        self.assertEqual(report['number_width'], 4)
+
+    def test_new_column(self):
+        rows = list(ROWS)
+        rows[1] = rows[1].replace('/>', ' Stock="5"/>')
+        self.assertIsNone(self.patch(shop(ROWS), shop(rows))['patched'])
+
+    def test_localized(self):
+        # Localized rows merge the main file in, so they are diffed after parsing
+        for directory in ('previous', 'input'):
+            write(self.path(directory, 'datatable_shop.xml'), shop(ROWS))
+        report = self.patch(shop([ROWS[1].replace('Bee', 'Bea')]), shop([ROWS[1]]), directory='eng')
+        self.assertEqual(report['patched'], 1)
+        self.assertEqual(report['original'], os.path.abspath(self.path('input', 'datatable_shop.xml')))
+
+    def test_class_schema(self):
+        schema = '\t<Schema><ClassSchema Price="STRING"/></Schema>\n'
+        rows = list(ROWS)
+        rows[1] = rows[1].replace('Price="20"', 'Price="free"')
+        self.assertEqual(self.patch(shop(ROWS, schema), shop(rows, schema))['patched'], 1)
+        # A changed schema changes the column layout, the ies is rebuilt
+        self.assertIsNone(self.patch(shop(ROWS), shop(ROWS, schema))['patched'])
+
+
+if __name__ == '__main__':
+    unittest.main()
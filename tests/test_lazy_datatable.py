@@ -0,0 +1,421 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ies2', 'lib'))
+
+from lxml import etree
+
+from lazy_datatable import Class, DataTable, LazyDataTables
+
+BASE = '''<?xml version="1.0" encoding="UTF-8"?>
+<idspace id="shop">
+\t<Class ClassID="1" ClassName="A" Price="10"/>
+\t<Class ClassID="3" ClassName="C" Price="30"/>
+\t<Class ClassID="5" ClassName="E" Price="10"/>
+</idspace>
+'''
+
+LOCALIZED = '''<?xml version="1.0" encoding="UTF-8"?>
+<idspace id="shop">
+\t<Class ClassID="3" ClassName="C" Name="Cee"/>
+</idspace>
+'''
+
+
+def write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as fp:
+        fp.write(text)
+
+
+def read(path):
+    with open(path, encoding='utf-8') as fp:
+        return fp.read()
+
+
+def touch_later(path):
+    # Changed files must get a new stamp even on coarse mtime clocks
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+
+
+class TableTestCase(unittest.TestCase):
+    locale = None
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.base_path = os.path.join(self.directory, 'datatable_shop.xml')
+        self.local_path = os.path.join(self.directory, 'eng', 'datatable_shop.xml')
+        write(self.base_path, BASE)
+        write(self.local_path, LOCALIZED)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def table(self, **kwargs):
+        return DataTable(self.directory, 'shop', self.locale, **kwargs)
+
+    def ids(self, classes):
+        return [cls['ClassID'] for cls in classes]
+
+
+class DataTableTest(TableTestCase):
+    def test_lookup(self):
+        dt = self.table()
+        self.assertEqual(dt.get_by_class_id('3')['ClassName'], 'C')
+        self.assertIs(dt.get_by_class_name('C'), dt.get_by_class_id('3'))
+        self.assertIsNone(dt.get_by_class_id('2'))
+        self.assertEqual(dt.import_key, 'ClassName')
+
+    def test_find_cls(self):
+        dt = self.table()
+        self.assertEqual(self.ids(dt.find_cls()), ['1', '3', '5'])
+        self.assertEqual(self.ids(dt.find_cls(Price='10')), ['1', '5'])
+        self.assertEqual(self.ids(dt.find_cls(Price='10', ClassName='C')), ['1', '3', '5'])
+        self.assertEqual(self.ids(dt.find_cls(condition='and', Price=10, ClassName='E')), ['5'])
+        self.assertIs(dt.get_cls(ClassID='3'), dt.get_by_class_id('3'))
+
+    def test_find_cls_after_edit(self):
+        dt = self.table()
+        self.assertEqual(self.ids(dt.find_cls(Price='10')), ['1', '5'])
+        dt.get_by_class_id('1')['Price'] = 20
+        self.assertEqual(self.ids(dt.find_cls(Price='10')), ['5'])
+        self.assertEqual(self.ids(dt.find_cls(Price='20')), ['1'])
+        self.assertTrue(dt.is_dirty)
+
+    def test_find_cls_after_tree_edit(self):
+        dt = self.table()
+        self.assertEqual(self.ids(dt.find_cls(Price='10')), ['1', '5'])
+        root = dt.xml
+        root[0].attrib['Price'] = '99'
+        root.append(etree.Element('Class', {'ClassID': '7', 'ClassName': 'G', 'Price': '99'}))
+        dt.mark_dirty()
+        self.assertEqual(self.ids(dt.find_cls(Price='99')), ['1', '7'])
+        self.assertEqual(self.ids(dt.find_cls(Price='10')), ['5'])
+        self.assertTrue(dt.insert_cls(Class(None, etree.Element('Class', {'ClassID': '6'}), None)))
+        self.assertEqual(self.ids(dt.find_cls()), ['1', '3', '5', '6', '7'])
+
+    def test_insert(self):
+        dt = self.table()
+        cls = Class(None, etree.Element('Class', {'ClassID': '4', 'ClassName': 'D', 'Price': '40'}), None)
+        self.assertTrue(dt.insert_cls(cls))
+        self.assertEqual(self.ids(dt.find_cls()), ['1', '3', '4', '5'])
+        self.assertIs(dt.get_by_class_name('D'), cls)
+        duplicate = Class(None, etree.Element('Class', {'ClassID': '4'}), None)
+        self.assertFalse(dt.insert_cls(duplicate))
+        self.assertIsNone(duplicate.getparent())
+
+    def test_insert_bulk(self):
+        dt = self.table()
+        classes = [Class(None, etree.Element('Class', {'ClassID': class_id}), None) for class_id in ('6', '2', '3')]
+        self.assertEqual(dt.insert_cls_bulk(classes), 2)
+        self.assertEqual(self.ids(dt.find_cls()), ['1', '2', '3', '5', '6'])
+
+    def test_inserted_class_is_found(self):
+        dt = self.table()
+        cls = Class(None, etree.Element('Class', {'ClassID': '4', 'Price': '40'}), None)
+        dt.insert_cls(cls)
+        self.assertIs(dt.get_cls(ClassID='4'), cls)
+        cls['Price'] = '41'
+        self.assertEqual(dt.get_cls(ClassID='4')['Price'], '41')
+
+    def test_class_after_tree_edit(self):
+        dt = self.table()
+        cls = dt.get_by_class_id('1')
+        self.assertEqual(cls['Price'], '10')
+        dt.xml.find('Class').attrib['Price'] = '99'
+        dt.mark_dirty()
+        self.assertEqual(cls['Price'], '99')
+        self.assertEqual(dt.get_cls(ClassID='1')['Price'], '99')
+
+    def test_save(self):
+        dt = self.table()
+        dt.get_by_class_id('3')['Price'] = '33'
+        dt.save()
+        self.assertEqual(self.table().get_by_class_id('3')['Price'], '33')
+
+    def test_delta_save(self):
+        dt = self.table()
+        dt.get_by_class_id('3')['Price'] = '33'
+        dt.save(delta=True)
+        self.assertEqual(read(self.base_path), BASE.replace('Price="30"', 'Price="33"'))
+        dt.get_by_class_id('5')['Price'] = '55'
+        dt.save(delta=True)
+        self.assertEqual(self.table().get_by_class_id('5')['Price'], '55')
+        self.assertEqual(self.table().get_by_class_id('3')['Price'], '33')
+
+    def test_delta_save_after_insert(self):
+        dt = self.table()
+        dt.insert_cls(Class(None, etree.Element('Class', {'ClassID': '4'}), None))
+        dt.save(delta=True)
+        self.assertEqual(self.ids(self.table().find_cls()), ['1', '3', '4', '5'])
+
+    def test_delta_save_of_changed_file(self):
+        dt = self.table()
+        write(self.base_path, BASE.replace('Price="10"', 'Price="12"'))
+        touch_later(self.base_path)
+        dt.get_by_class_id('3')['Price'] = '33'
+        dt.save(delta=True)
+        # The file is not the one parsed, so it is written whole from the tree
+        self.assertEqual(self.ids(self.table().find_cls(Price='10')), ['1', '5'])
+        self.assertEqual(self.table().get_by_class_id('3')['Price'], '33')
+
+    def test_batch(self):
+        dt = self.table()
+        with dt.batch():
+            dt.get_by_class_id('1')['ClassName'] = 'AA'
+            dt.get_by_class_id('5')['Price'] = '50'
+        self.assertEqual(dt.get_by_class_name('AA')['ClassID'], '1')
+        self.assertIsNone(dt.get_by_class_name('A'))
+        self.assertEqual(self.ids(dt.find_cls(Price='50')), ['5'])
+        dt.save(delta=True)
+        self.assertEqual(self.table().get_by_class_name('AA')['Price'], '10')
+
+    def test_batch_rollback(self):
+        dt = self.table()
+        with self.assertRaises(KeyError):
+            with dt.batch():
+                dt.get_by_class_id('1')['ClassName'] = 'AA'
+                dt.get_by_class_id('5')['Price'] = '50'
+                raise KeyError()
+        self.assertEqual(dt.get_by_class_id('5')['Price'], '10')
+        self.assertEqual(dt.get_by_class_name('A')['ClassID'], '1')
+        self.assertIsNone(dt.get_by_class_name('AA'))
+        self.assertFalse(dt.is_dirty)
+
+    def test_snapshot(self):
+        self.table(snapshot=True)
+        dt = self.table(snapshot=True)
+        self.assertIsNotNone(dt._snapshot_rows)
+        self.assertEqual(self.ids(dt.find_cls()), ['1', '3', '5'])
+        cls = dt.get_by_class_id('3')
+        cls['Price'] = '33'
+        self.assertIsNone(dt._snapshot_rows)
+        self.assertIs(dt.get_cls(Price='33'), cls)
+        dt.save(delta=True)
+        self.assertEqual(self.table(snapshot=True).get_by_class_id('3')['Price'], '33')
+
+    def test_snapshot_is_json(self):
+        self.table(snapshot=True)
+        path = os.path.join(self.directory, '.datatable_shop{}.snapshot'.format(
+            '' if self.locale is None else '.' + self.locale))
+        with open(path, encoding='utf-8') as fp:
+            self.assertEqual(json.load(fp)['version'], DataTable.snapshot_version)
+        write(path, '{"version": 2, "stamps": ')
+        dt = self.table(snapshot=True)
+        self.assertIsNone(dt._snapshot_rows)
+        self.assertEqual(self.ids(dt.find_cls()), ['1', '3', '5'])
+
+    def test_snapshot_of_changed_file(self):
+        self.table(snapshot=True)
+        dt = self.table(snapshot=True)
+        first, third, fifth = dt.get_by_class_id('1'), dt.get_by_class_id('3'), dt.get_by_class_id('5')
+        # Rows shift after the snapshot was loaded, pairing them by position would mix them up
+        write(self.base_path, BASE.replace('\t<Class ClassID="1" ClassName="A" Price="10"/>\n', '')
+              .replace('Price="10"', 'Price="11"'))
+        touch_later(self.base_path)
+        third['Price'] = '33'
+        self.assertEqual(third['ClassName'], 'C')
+        self.assertEqual(fifth['Price'], '11')
+        self.assertIs(dt.get_cls(ClassID='5'), fifth)
+        self.assertIsNone(first.getparent())
+        self.assertIsNone(dt.get_by_class_id('1'))
+        self.assertEqual(self.ids(dt.find_cls()), ['3', '5'])
+
+    def test_snapshot_row_removed_from_changed_file(self):
+        self.table(snapshot=True)
+        tables = self.table(snapshot=True), self.table(snapshot=True)
+        write(self.base_path, BASE.replace('\t<Class ClassID="1" ClassName="A" Price="10"/>\n', ''))
+        touch_later(self.base_path)
+        with self.assertRaisesRegex(Exception, 'Class 1 was removed'):
+            tables[0].get_by_class_id('1')['Price'] = '11'
+        with self.assertRaisesRegex(Exception, 'Class 1 was removed'):
+            del tables[1].get_by_class_id('1')['Price']
+        for dt in tables:
+            self.assertEqual(self.ids(dt.find_cls()), ['3', '5'])
+            self.assertFalse(dt.is_dirty)
+
+    def test_snapshot_class_key_change(self):
+        self.table(snapshot=True)
+        dt = self.table(snapshot=True)
+        touch_later(self.base_path)
+        cls = dt.get_by_class_id('3')
+        cls['ClassName'] = 'CC'
+        self.assertIs(dt.get_by_class_name('CC'), cls)
+        self.assertIsNone(dt.get_by_class_name('C'))
+        cls['ClassID'] = '4'
+        self.assertIs(dt.get_by_class_id('4'), cls)
+        self.assertIsNone(dt.get_by_class_id('3'))
+
+
+class LocalizedDataTableTest(TableTestCase):
+    locale = 'eng'
+
+    def local_class(self, class_id, **attrib):
+        return Class(None, None, etree.Element('Class', dict(attrib, ClassID=class_id)))
+
+    def test_lookup(self):
+        dt = self.table()
+        self.assertEqual(dt.get_by_class_id('3')['Name'], 'Cee')
+        self.assertEqual(dt.get_by_class_id('3')['Price'], '30')
+        self.assertIsNone(dt.get_by_class_id('1').get('Name'))
+        self.assertEqual(self.ids(dt.find_cls(Name='Cee')), ['3'])
+
+    def test_tree_reads_keep_indexes(self):
+        dt = self.table()
+        self.assertEqual(self.ids(dt.find_cls(Name='Cee')), ['3'])
+        indexes = dict(dt._attribute_indexes)
+        for cls in dt.find_cls():
+            self.assertIsNotNone(dt.xml_localized)
+            self.assertIsNotNone(dt.xml)
+        self.assertEqual(dt._attribute_indexes, indexes)
+        self.assertIsNotNone(dt._localized_by_class_id)
+
+    def test_edit_goes_to_localized_file(self):
+        dt = self.table()
+        dt.get_by_class_id('1')['Price'] = '11'
+        dt.get_by_class_id('3')['Name'] = 'See'
+        dt.save(delta=True)
+        self.assertEqual(read(self.base_path), BASE)
+        dt = self.table()
+        self.assertEqual(dt.get_by_class_id('1')['Price'], '11')
+        self.assertEqual(dt.get_by_class_id('3')['Name'], 'See')
+
+    def test_delta_save(self):
+        dt = self.table()
+        dt.get_by_class_id('3')['Name'] = 'See'
+        dt.save(delta=True)
+        self.assertEqual(read(self.local_path), LOCALIZED.replace('Cee', 'See'))
+
+    def test_insert(self):
+        dt = self.table()
+        cls = self.local_class('4', Name='Dee')
+        self.assertTrue(dt.insert_cls(cls))
+        self.assertFalse(dt.insert_cls(self.local_class('3')))
+        self.assertIs(dt.get_cls(ClassID='4'), cls)
+        self.assertIs(dt.get_by_class_id('4'), cls)
+        cls['Name'] = 'Dii'
+        self.assertEqual(dt.get_cls(ClassID='4')['Name'], 'Dii')
+        dt.save(delta=True)
+        self.assertEqual(self.table().get_by_class_id('4')['Name'], 'Dii')
+        self.assertEqual(read(self.base_path), BASE)
+
+    def test_batch(self):
+        dt = self.table()
+        with dt.batch():
+            dt.get_by_class_id('5')['Name'] = 'Eee'
+            dt.get_by_class_id('1')['ClassName'] = 'AA'
+        self.assertEqual(self.ids(dt.find_cls(Name='Eee')), ['5'])
+        self.assertEqual(dt.get_by_class_name('AA')['ClassID'], '1')
+        dt.save(delta=True)
+        self.assertEqual(self.table().get_by_class_id('5')['Name'], 'Eee')
+
+    def test_batch_query_keeps_created_element(self):
+        dt = self.table()
+        with dt.batch():
+            cls = dt.get_by_class_id('1')
+            cls['Price'] = '31'
+            # Looked up again while its localized element is not in the tree yet
+            self.assertIs(dt.get_cls(ClassName='A'), cls)
+            self.assertEqual(self.ids(dt.find_cls()), ['1', '3', '5'])
+            cls['Name'] = 'Ay'
+        self.assertEqual(cls['Price'], '31')
+        self.assertEqual(cls['Name'], 'Ay')
+        dt.save(delta=True)
+        saved = self.table().get_by_class_id('1')
+        self.assertEqual(saved['Price'], '31')
+        self.assertEqual(saved['Name'], 'Ay')
+
+    def test_batch_rollback(self):
+        dt = self.table()
+        with self.assertRaises(KeyError):
+            with dt.batch():
+                dt.get_by_class_id('5')['Name'] = 'Eee'
+                raise KeyError()
+        self.assertIsNone(dt.get_by_class_id('5').get('Name'))
+        self.assertEqual(self.ids(dt.find_cls(Name='Eee')), [])
+        self.assertEqual(len(dt.xml_localized), 1)
+
+    def test_snapshot(self):
+        self.table(snapshot=True)
+        dt = self.table(snapshot=True)
+        self.assertIsNotNone(dt._snapshot_rows)
+        cls = dt.get_by_class_id('3')
+        self.assertEqual(cls['Name'], 'Cee')
+        cls['Name'] = 'See'
+        self.assertIsNone(dt._snapshot_rows)
+        self.assertIs(dt.get_cls(ClassID='3'), cls)
+        dt.save(delta=True)
+        self.assertEqual(self.table(snapshot=True).get_by_class_id('3')['Name'], 'See')
+
+    def test_snapshot_of_changed_file(self):
+        self.table(snapshot=True)
+        dt = self.table(snapshot=True)
+        first, third = dt.get_by_class_id('1'), dt.get_by_class_id('3')
+        write(self.local_path, LOCALIZED.replace('<Class ClassID="3"',
+                                                 '<Class ClassID="1" Name="Ay"/>\n\t<Class ClassID="3"'))
+        touch_later(self.local_path)
+        third['Price'] = '33'
+        self.assertEqual(first['Name'], 'Ay')
+        self.assertEqual(third['Name'], 'Cee')
+        self.assertIs(dt.get_cls(ClassID='3'), third)
+        self.assertIs(dt.get_by_class_id('1'), first)
+
+
+class LazyDataTablesTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for i, name in enumerate(('monster',) + LazyDataTables.monster_datatables):
+            write(os.path.join(self.directory, 'datatable_{}.xml'.format(name)),
+                  '<?xml version="1.0" encoding="UTF-8"?>\n<idspace id="{}">\n'
+                  '\t<Class ClassID="{}" ClassName="M{}"/>\n</idspace>\n'.format(name, i + 1, i + 1))
+        write(os.path.join(self.directory, 'datatable_shop.xml'), BASE)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def index_path(self):
+        return os.path.join(self.directory, LazyDataTables.index_cache_name)
+
+    def test_group_lookup(self):
+        tables = LazyDataTables(self.directory)
+        self.assertEqual(tables.get_by_class_name('monster', 'M3')['ClassID'], '3')
+        self.assertTrue(os.path.exists(self.index_path()))
+        tables = LazyDataTables(self.directory)
+        self.assertEqual(tables.get_by_class_id('monster', '4')['ClassName'], 'M4')
+        self.assertEqual(list(tables.data_tables), ['monster_3'])
+
+    def test_group_index_of_dirty_tables(self):
+        tables = LazyDataTables(self.directory)
+        tables.get_datatable('monster_2').get_by_class_id('3')['ClassName'] = 'Renamed'
+        self.assertEqual(tables.get_by_class_name('monster', 'Renamed')['ClassID'], '3')
+        self.assertFalse(os.path.exists(self.index_path()))
+        tables = LazyDataTables(self.directory)
+        self.assertIsNone(tables.get_by_class_name('monster', 'Renamed'))
+        self.assertEqual(tables.get_by_class_name('monster', 'M3')['ClassID'], '3')
+
+    def test_prefetch(self):
+        sequential = LazyDataTables(self.directory)
+        list(sequential.get_datatables('monster'))
+        tables = LazyDataTables(self.directory)
+        tables.prefetch('monster', workers=2)
+        self.assertEqual(list(tables.data_tables), list(sequential.data_tables))
+        for name, dt in tables.data_tables.items():
+            self.assertEqual(list(dt._by_class_id), list(sequential.data_tables[name]._by_class_id))
+
+    def test_create_cls(self):
+        tables = LazyDataTables(self.directory)
+        cls = tables.create_cls('shop', '4')
+        cls['Price'] = '40'
+        self.assertIs(tables.get_cls('shop', ClassID='4'), cls)
+        self.assertEqual(tables.get_cls('shop', Price='40')['ClassID'], '4')
+        tables.save(delta=True)
+        self.assertEqual(LazyDataTables(self.directory).get_by_class_id('shop', '4')['Price'], '40')
+
+
+if __name__ == '__main__':
+    unittest.main()